@@ -85,6 +85,9 @@ module TopoDot = struct
       | Dot_ast.Ident("dport") -> {edge with Core.Link.dstport = VInt.Int32 (int32_of_id valopt)}
       | Dot_ast.Ident("cost") -> {edge with Core.Link.cost = VInt.Int64 (int64_of_id valopt) }
       | Dot_ast.Ident("capacity") -> {edge with Core.Link.capacity = VInt.Int64 (capacity_of_id valopt)}
+      (* a link aggregated by fattree.py --aggregate: the other members are
+         on the following ports, and the capacity is already their sum *)
+      | Dot_ast.Ident("ports") -> edge
       | _ -> failwith "Unknown edge attribute\n"
 
   (* Generate a node from the id and attributes *)
@@ -16,46 +16,170 @@ import sys
 import argparse
 import pprint
 import string
-import networkx as nx
-from mininet.util import macColonHex, ipAdd
+import itertools
+import os
+import json
+from array import array
+import profiling
+import dotwriter
+import flowtable
+import netkat
+
+# '00' .. 'ff'
+HEXBYTES = ['%02x' % (b) for b in range(256)]
+DECBYTES = [str(b) for b in range(256)]
+
+def mac_strings(first, count):
+    '''colon-hex MACs of the integers first .. first+count-1, as given by
+    mininet's macColonHex. Only the last byte changes within a block of 256,
+    so the first five are formatted once per block.'''
+    macs = []
+    last = first + count
+    n = first
+    while n < last:
+        high = n >> 8
+        end = min(last, (high + 1) << 8)
+        prefix = string.join([HEXBYTES[(high >> shift) & 0xff] for shift in (32, 24, 16, 8, 0)], ":") + ":"
+        macs.extend([prefix + b for b in HEXBYTES[n & 0xff:((end - 1) & 0xff) + 1]])
+        n = end
+    return macs
+
+def ip_strings(first, count, prefixLen=8, ipBase=0x0a000000):
+    '''dotted IPs of the integers first .. first+count-1 added to ipBase, as
+    given by mininet's ipAdd'''
+    imax = 0xffffffff >> prefixLen
+    assert first + count - 1 <= imax, 'Not enough IP addresses in the subnet'
+    base = ipBase & (0xffffffff ^ imax)
+    ips = []
+    last = base + first + count
+    n = base + first
+    while n < last:
+        high = n >> 8
+        end = min(last, (high + 1) << 8)
+        prefix = "%d.%d.%d." % ((high >> 16) & 0xff, (high >> 8) & 0xff, high & 0xff)
+        ips.extend([prefix + b for b in DECBYTES[n & 0xff:((end - 1) & 0xff) + 1]])
+        n = end
+    return ips
+
+def ip_prefixes(first, last):
+    '''yields (n, bits) for the fewest aligned blocks n .. n+2**bits-1 that
+    cover the integers first .. last. A block is an IP prefix only if it is
+    aligned on the IP itself, so the blocks of host ids are aligned on the
+    id, not on id - 1: h1 is 10.0.0.1, and 10.0.0.0/30 would match h1..h3
+    and not h4.'''
+    while first <= last:
+        bits = 0
+        while first % (2 << bits) == 0 and first + (2 << bits) - 1 <= last:
+            bits += 1
+        yield first, bits
+        first += 1 << bits
+
+KATTYPES = ['tables', 'paths', 'regular', 'realpaths', 'realnoidpaths', 'testpaths', 'testpaths2', 'testrealpaths', 'testrealpaths2', 'testnoidrealpaths', 'testnoidrealpaths2', 'testtables']
+
+class ABFatTree(object):
+    '''AB fat tree with integer node ids: switches s1..sS are 0..S-1, in level
+    order, and hosts h1..hH are S..S+H-1. Links are kept as columns of src,
+    dst, sport and dport; every link has the same capacity and cost.'''
+
+    capacity = '1Gbps'
+    cost = '1'
+    # match the hosts below a switch by ip4Dst prefixes (--prefixes)
+    prefixes = False
+
+    def __init__(self, fanout, depth):
+        self.L = depth - 1
+        self.p = fanout / 2
+        # switches per level, except for the core which has half as many
+        self.width = 2 * (self.p ** self.L)
+        self.nswitches = (2*self.L + 1) * (self.p ** self.L)
+        self.nhosts = 2 * (self.p ** (self.L+1))
+        self.switches = range(self.nswitches)
+        self.hosts = range(self.nswitches, self.nswitches + self.nhosts)
+        n = self.nswitches
+        nc = self.p ** self.L
+        self.core_switches = self.switches[(n-nc):]
+        self.edge_switches = self.switches[0:self.width]
+        self.agg_switches = self.switches[self.width:(n-nc)]
+        self.src = array('i')
+        self.dst = array('i')
+        self.sport = array('i')
+        self.dport = array('i')
+
+    def add_link(self, a, b, aport, bport):
+        '''adds the links a -> b and b -> a'''
+        self.src.append(a)
+        self.dst.append(b)
+        self.sport.append(aport)
+        self.dport.append(bport)
+        self.src.append(b)
+        self.dst.append(a)
+        self.sport.append(bport)
+        self.dport.append(aport)
+
+    def edges(self):
+        '''yields (src, dst, sport, dport) for every link'''
+        return itertools.izip(self.src, self.dst, self.sport, self.dport)
+
+    def is_host(self, node):
+        return node >= self.nswitches
+
+    def id(self, node):
+        if node >= self.nswitches:
+            return node - self.nswitches + 1
+        return node + 1
+
+    def name(self, node):
+        if node >= self.nswitches:
+            return 'h' + str(node - self.nswitches + 1)
+        return 's' + str(node + 1)
+
+    def node(self, name):
+        '''the node called name, e.g. s3 or h5'''
+        if name[1:].isdigit():
+            n = int(name[1:])
+            if name[0] == 'h' and 1 <= n <= self.nhosts:
+                return self.nswitches + n - 1
+            if name[0] == 's' and 1 <= n <= self.nswitches:
+                return n - 1
+        raise ValueError("no node %s" % (name))
+
+    def level(self, node):
+        return node / self.width
+
+    def mac(self, node):
+        return self.macs[node - self.nswitches]
+
+    def dot_nodes(self):
+        '''yields (name, attrs) for every node'''
+        for node in self.switches:
+            yield self.name(node), {'type': 'switch', 'id': self.id(node)}
+        ips = ip_strings(1, self.nhosts)
+        for node in self.hosts:
+            yield self.name(node), {'type': 'host', 'id': self.id(node),
+                                    'mac': self.mac(node), 'ip': ips[node - self.nswitches]}
+
+    def dot_edges(self):
+        '''yields (src, dst, attrs) for every link'''
+        for src, dst, sport, dport in self.edges():
+            yield self.name(src), self.name(dst), \
+                {'sport': sport, 'dport': dport, 'capacity': self.capacity, 'cost': self.cost}
+
+    def write_dot(self, f):
+        dotwriter.write_dot(f, 'abfattree', self.dot_nodes(), self.dot_edges())
 
 def generate(fanout,depth):
-    L = depth - 1
-    p = fanout / 2
-    switches = ['s'+ str(i) for i in range(1, ((2*L + 1) * (p ** L)+1))]
-    hosts = ['h' + str(i) for i in range(1, 2 * (p ** (L+1)) + 1)]
-    nodes = switches + hosts
-    graph = nx.DiGraph()
-    for node in switches:
-        graph.add_node(node, type='switch', id=int(node[1:]))
-    for node in hosts:
-        graph.add_node(node, type='host',
-            id=int(node[1:]),
-            mac=macColonHex( int(node[1:]) ),
-            ip=ipAdd( int(node[1:]) ) )
-
-
-    graph.switches = switches
-    graph.hosts = hosts
-    graph.p = p
-    graph.L = L
-    n = len(switches)
-    nc = p**L
-    graph.core_switches = switches[(n-nc):]
-    ne = 2*p**L
-    graph.edge_switches = switches[0:ne]
-    graph.agg_switches = switches[ne:(n-nc)]
-    assert len(graph.core_switches) + len(graph.edge_switches) + len(graph.agg_switches) == len(switches)
+    graph = ABFatTree(fanout, depth)
+    p = graph.p
+    L = graph.L
+    hosts = graph.hosts
+    graph.macs = mac_strings(1, graph.nhosts)
 
     for idx in range(2 * (p ** (depth-1))):
-        node = nodes[idx]
+        node = idx
         c = 1
         for j in range(idx*p, idx*p + p):
             hostnode = hosts[j]
-            graph.add_edge(hostnode, node,
-                attr_dict={'sport':1,'dport':c,'capacity':'1Gbps','cost':'1'})
-            graph.add_edge(node, hostnode,
-                attr_dict={'sport':c,'dport':1,'capacity':'1Gbps','cost':'1'})
+            graph.add_link(hostnode, node, 1, c)
             #print "dport: %d" % (c)
             c += 1
 
@@ -67,7 +191,7 @@ def generate(fanout,depth):
             for j in range(p ** i):
                 idx = i * 2 * (p ** L) + g * (p ** i) + j
                 #print "i, g, j, idx, sstype: %d %d %d %d %d" % (i, g, j, idx, sttype)
-                node = nodes[idx]
+                node = idx
                 if i < L - 1:
                     parentsg = g / p
                 else:
@@ -83,7 +207,7 @@ def generate(fanout,depth):
                 c = 1
                 assert len(parentsidxs) == p
                 for pidx in parentsidxs:
-                    parentnode = nodes[pidx]
+                    parentnode = pidx
                     sport = p + c
                     c += 1
                     if i < L - 1:
@@ -93,612 +217,1009 @@ def generate(fanout,depth):
                     assert sport <= 2*p
                     assert dport <= 2*p
                     #print "dport: %d" % (dport)
-                    graph.add_edge(node, parentnode,
-                        attr_dict={'sport':sport,'dport':dport,'capacity':'1Gbps','cost':'1'})
-                    graph.add_edge(parentnode, node,
-                        attr_dict={'sport':dport,'dport':sport,'capacity':'1Gbps','cost':'1'})
+                    graph.add_link(node, parentnode, sport, dport)
+    index_ports(graph)
+    index_hosts_below(graph)
     return graph
 
-def rec_routing_downwards(graph, node, host, level):
-    upwards = [x for x in graph.neighbors_iter(node) if (x not in graph.hosts and graph.node[x]['level'] == level)]
-    for upnode in upwards:
-        e = graph.get_edge_data(node, upnode)
-        graph.node[upnode]['routes'][host] = e['dport']
-        if level+1 <= graph.L:
-            rec_routing_downwards(graph, upnode, host, level+1)
-
-def routing_upwards(graph, node):
+def index_ports(graph):
+    '''precomputes the lookups done on every hop: for port 1..2p of node,
+    peer[node*(2p+1) + port] is the node at the other end of the link (-1 if
+    the port is unused) and peer_port[..] the port it arrives on'''
+    stride = 2*graph.p + 1
+    nnodes = graph.nswitches + graph.nhosts
+    graph.peer = array('i', [-1]) * (nnodes * stride)
+    graph.peer_port = array('i', [0]) * (nnodes * stride)
+    for src, dst, sport, dport in graph.edges():
+        graph.peer[src*stride + sport] = dst
+        graph.peer_port[src*stride + sport] = dport
+
+def up_ports(graph, node):
     # by convention, port > p is facing upwards except for level L
-    for port in range(1, graph.p+1):
-        graph.node[node]['routes'][port] = graph.p + port
-
-def to_netkat_set_of_tables_for_switches(graph, switches, withTopo=True):
-    policy = []
-    edge_policy = []
-    for node in switches:
-        table = []
-        edge_table = []
-        flt = "filter switch = %d" % (graph.node[node]['id'])
-        #pprint.pprint(graph.node[node]['routes'])
-        for k, v in graph.node[node]['routes'].iteritems():
-            if k in graph.hosts:
-                s = string.join((flt, "ethDst = %s" % (graph.node[k]['mac'])), " and ")
-                s = string.join((s, "port := %d" % (v)), "; ")
-                if graph.node[node]['level'] == 0:
-                    edge_table.append(s)
+    if graph.is_host(node):
+        return [1]
+    if graph.level(node) == graph.L:
+        return []
+    return range(graph.p+1, 2*graph.p+1)
+
+def down_ports(graph, node):
+    if graph.level(node) == graph.L:
+        return range(1, 2*graph.p+1)
+    return range(1, graph.p+1)
+
+def index_hosts_below(graph):
+    '''hosts get contiguous ids in generate(), so the hosts below a switch are
+    stored as the node range (first, last); switches are visited bottom-up,
+    which is id order'''
+    graph.hosts_below = {}
+    graph.not_hosts_below = {}
+    graph.switch_filters = {}
+    for node in graph.switches:
+        below = []
+        for port in down_ports(graph, node):
+            k = graph.peer[node*(2*graph.p + 1) + port]
+            if graph.is_host(k):
+                below.append((k, k))
+            else:
+                below.append(graph.hosts_below[k])
+        first = min([r[0] for r in below])
+        last = max([r[1] for r in below])
+        assert last - first + 1 == sum([r[1] - r[0] + 1 for r in below])
+        graph.hosts_below[node] = (first, last)
+
+def not_hosts_below_filter(graph, node):
+    '''"not ethDst = .." for every host below node, built once per switch.
+    With graph.prefixes, the hosts are matched by the few ip4Dst prefixes that
+    cover their contiguous IPs instead, which is the same filter for packets
+    addressed to the IP that goes with their MAC.'''
+    if node not in graph.not_hosts_below:
+        if graph.prefixes:
+            first, last = graph.hosts_below[node]
+            terms = []
+            # the IP of host id k is 10.0.0.k (ip_strings(k, 1)), and 10.0.0.0
+            # is aligned on any block, so blocks of ids are blocks of IPs
+            for n, bits in ip_prefixes(graph.id(first), graph.id(last)):
+                if bits:
+                    terms.append(netkat.test('ip4Dst', "%s/%d" % (ip_strings(n, 1)[0], 32 - bits)))
                 else:
-                    table.append(s)
+                    terms.append(netkat.test('ip4Dst', ip_strings(n, 1)[0]))
+        else:
+            terms = [netkat.test('ethDst', graph.mac(x)) for x in find_all_hosts_below(graph, node)]
+        graph.not_hosts_below[node] = netkat.conj(*map(netkat.neg, terms))
+    return graph.not_hosts_below[node]
+
+def compute_routes(graph):
+    '''fills the routing tables of every switch in one pass, from the host
+    ranges below its down ports:
+    down[node*H + host-S] = port towards host, 0 if host is not below node
+    up[node*(2p+1) + inport] = port to send up traffic from inport on, 0 at
+    the core'''
+    stride = 2*graph.p + 1
+    typecode = 'B' if 2*graph.p < 256 else 'H'
+    graph.down = array(typecode, [0]) * (graph.nswitches * graph.nhosts)
+    graph.up = array(typecode, [0]) * (graph.nswitches * stride)
+    for node in graph.switches:
+        base = node*graph.nhosts - graph.nswitches
+        for port in down_ports(graph, node):
+            k = graph.peer[node*stride + port]
+            if graph.is_host(k):
+                first, last = k, k
             else:
-                hosts = find_all_hosts_below(graph, node)
-                fltouthosts = string.join(map(lambda x: "not ethDst = %s" % (graph.node[x]['mac']), hosts), " and ")
-                s = string.join((flt, "port = %d" % (k), fltouthosts), " and ")
-                s = string.join((s, "port := %d" % (v)), "; ")
-                table.append(s)
-        #pprint.pprint(table)
-        policy.extend(table)
-        edge_policy.extend(edge_table)
+                first, last = graph.hosts_below[k]
+            graph.down[base+first:base+last+1] = array(typecode, [port]) * (last - first + 1)
+        # by convention, port > p is facing upwards except for level L
+        if graph.level(node) < graph.L:
+            for port in range(1, graph.p+1):
+                graph.up[node*stride + port] = graph.p + port
+
+def route_to_host(graph, node, host):
+    return graph.down[node*graph.nhosts + host - graph.nswitches]
+
+def route_up(graph, node, inport):
+    return graph.up[node*(2*graph.p + 1) + inport]
+
+def routes_of(graph, node):
+    '''the route entries of a switch: (inport, outport) for the up ports,
+    then (host, outport), ordered by inport and host'''
+    entries = []
+    for port in range(1, 2*graph.p+1):
+        v = route_up(graph, node, port)
+        if v:
+            entries.append((port, v))
+    first, last = graph.hosts_below[node]
+    for host in range(first, last + 1):
+        entries.append((host, route_to_host(graph, node, host)))
+    return entries
+
+def program(policy, topo, edge_policy, edge_topo):
+    '''((policy); (topo))*; ((edge_policy); (edge_topo)), where the four
+    are streamed terms'''
+    return netkat.seq(netkat.star(pair(policy, topo)), pair(edge_policy, edge_topo))
+
+def pair(policy, topo):
+    '''((policy); (topo))'''
+    return netkat.group(netkat.seq(netkat.group(netkat.stream(policy)), netkat.group(netkat.stream(topo))))
+
+def local_program(policy, edge_policy):
+    return netkat.stream(itertools.chain(policy, edge_policy))
+
+# the terms that are built once per link, entry or path, over shared nodes
+LINK = netkat.form(('link', 0, 1, 2, 3))
+GROUP = netkat.form(('group', 0))
+RULE = netkat.form(('seq', ('filter', ('and', 0, 1)), 2))
+PORT_RULE = netkat.form(('seq', ('filter', ('and', 0, 1, 2)), 3))
+HOST_RULE = netkat.form(('seq', 0, ('filter', 1), 2))
+PATH = netkat.form(('group', ('seq', ('filter', 0), ('filter', 1), 2)))
+PATH_LAST = netkat.form(('group', ('seq', ('filter', 0), ('filter', 1), 2, 3)))
+BACKUP = netkat.form(('group', ('union', ('group', 0), ('group', 1))))
+SPACED = netkat.form(('spaced', 0))
+SPACED_BACKUP = netkat.form(('spaced', ('union', 0, 1)))
+
+def topology_of_switches(graph, switches):
+    for src, dst, sport, dport in graph.edges():
+        if graph.is_host(src) or graph.is_host(dst):
+            continue
+        if src in switches or dst in switches:
+            yield LINK(graph.id(src), sport, graph.id(dst), dport)
 
-    if withTopo:
-        topo = []
-        for src, dst, ed in graph.edges_iter(data=True):
-            if src in graph.hosts or dst in graph.hosts:
+def edge_topology_of_switches(graph, switches):
+    for host in graph.hosts:
+        dst, inport = find_next_node(graph, host, 1)
+        if dst in switches:
+            yield LINK(graph.id(dst), inport, 0, graph.id(host))
+
+def table_rules(graph, switches, edge, keep=None):
+    '''yields (node, inport, host, outports) for the host entries of the edge
+    switches if edge is set, and all the other entries otherwise. inport is 0
+    if the entry matches any port and host is None if it matches every host
+    that is not below node. If keep is given, only the entries for which
+    keep(node, outports) holds are built.'''
+    for node in switches:
+        for k, v in routes_of(graph, node):
+            if keep is not None and not keep(node, (v,)):
                 continue
-            if src in switches or dst in switches:
-                topoterm = "%s@%d => %s@%d" % (graph.node[src]['id'], ed['sport'], graph.node[dst]['id'], ed['dport'])
-                topo.append(topoterm)
-
-        edge_topo = []
-        for host in graph.hosts:
-            dst = graph.neighbors(host)[0]
-            if dst in switches:
-                ed = graph.get_edge_data(host, dst)
-                topoterm = "%s@%d => 0@%d" % (graph.node[dst]['id'], ed['dport'], graph.node[host]['id'])
-                edge_topo.append(topoterm)
-
-        return "((\n%s\n);\n(\n%s\n))*;\n((\n%s\n);\n(\n%s\n))" % \
-            (string.join(policy, " |\n"), string.join(topo, " |\n"),
-             string.join(edge_policy, " |\n"), string.join(edge_topo, " |\n"))
+            if graph.is_host(k):
+                if (graph.level(node) == 0) != edge:
+                    continue
+                yield node, 0, k, (v,)
+            elif not edge:
+                yield node, k, None, (v,)
+
+def switch_filter(graph, node):
+    '''"filter switch = n", built once per switch'''
+    flt = graph.switch_filters.get(node)
+    if flt is None:
+        flt = graph.switch_filters[node] = netkat.filter(netkat.test('switch', graph.id(node)))
+    return flt
+
+def host_tests(graph, field):
+    '''"field = mac" for every host, by host index'''
+    return [netkat.test(field, mac) for mac in graph.macs]
+
+def rule_builder(graph, parts=False):
+    '''returns rule(node, inport, host, outports), the policy of a rule of
+    table_rules or failover_rules: "filter switch = n and port = inport and
+    dst; actions", with one action per output port, or with parts, its
+    (switch test, other tests, actions). The tests and actions are built
+    once and shared by all the rules that have them; the rule itself is a
+    term.'''
+    S = graph.nswitches
+    dsts = [netkat.test('ethDst', mac) for mac in graph.macs]
+    ports = [netkat.test('port', port) for port in range(2*graph.p + 1)]
+    flts = {}
+    acts = {}
+    def rule(node, inport, host, outports):
+        flt = flts.get(node)
+        if flt is None:
+            flt = flts[node] = netkat.test('switch', graph.id(node))
+        act = acts.get(outports)
+        if act is None:
+            act = netkat.union(*[netkat.mod('port', v) for v in outports])
+            if len(outports) > 1:
+                act = netkat.group(act)
+            acts[outports] = act
+        if host is None:
+            dst = not_hosts_below_filter(graph, node)
+        else:
+            dst = dsts[host - S]
+        if parts:
+            return flt, (ports[inport], dst) if inport else (dst,), act
+        if inport:
+            return PORT_RULE(flt, ports[inport], dst, act)
+        return RULE(flt, dst, act)
+    return rule
+
+def set_of_tables_for_switches(graph, switches, edge, parts=False):
+    rule = rule_builder(graph, parts)
+    for r in table_rules(graph, switches, edge):
+        yield rule(*r)
+
+def tables_of_switches(flts, rules):
+    '''((flt | ...); (rule | ...))'''
+    return netkat.group(netkat.seq(netkat.group(netkat.union(*flts)), netkat.group(netkat.union(*rules))))
+
+def factored(graph, rules):
+    '''groups the rules, as the parts of rule_builder, that are the same but
+    for the switch test, then these rules by the set of switches that have them,
+    and yields one "((filter switch = a | ...); (rule | ...))" term per
+    set, in the order the sets first appear. The union of the terms is the
+    same policy, with every distinct table written once.'''
+    flts_of = {}
+    bodies = []
+    for flt, tests, act in rules:
+        graph.rules += 1
+        body = (tests, act)
+        if body not in flts_of:
+            flts_of[body] = []
+            bodies.append(body)
+        flts_of[body].append(flt)
+    rules_of = {}
+    groups = []
+    for body in bodies:
+        group = tuple(flts_of.pop(body))
+        if group not in rules_of:
+            rules_of[group] = []
+            groups.append(group)
+        tests, act = body
+        rules_of[group].append(netkat.seq(netkat.filter(netkat.conj(*tests)), act))
+    for group in groups:
+        yield tables_of_switches(map(netkat.filter, group), rules_of[group])
+
+def to_netkat_set_of_tables_for_switches(graph, switches, withTopo=True, factor=False):
+    if factor:
+        policy = factored(graph, set_of_tables_for_switches(graph, switches, False, True))
+        edge_policy = factored(graph, set_of_tables_for_switches(graph, switches, True, True))
     else:
-        policy.extend(edge_policy)
-        return "%s\n" % (string.join(policy, " |\n"))
-
-def to_netkat_set_of_tables(graph, withTopo=True):
-    return to_netkat_set_of_tables_for_switches(graph, graph.switches, withTopo) 
-
-def to_netkat_test_set_of_tables(graph, withTopo=True):
-    return to_netkat_set_of_tables_for_switches(graph, (graph.switches[0], graph.switches[1], graph.switches[8], graph.switches[9]), withTopo) 
-
-def to_netkat_set_of_tables_failover_for_switches(graph, switches, withTopo=True, specializeInPort=True):
-    policy = []
-    edge_policy = []
-    # edge
-    for node in graph.edge_switches:
-        if not node in switches:
-            continue
-        table = []
-        edge_table = []
-        flt = "filter switch = %d" % (graph.node[node]['id'])
-        #pprint.pprint(graph.node[node]['routes'])
-        for k, v in graph.node[node]['routes'].iteritems():
-            if k in graph.hosts:
-                s = string.join((flt, "ethDst = %s" % (graph.node[k]['mac'])), " and ")
-                s = string.join((s, "port := %d" % (v)), "; ")
-                if graph.node[node]['level'] == 0:
-                    edge_table.append(s)
-                else:
-                    table.append(s)
-            else:
-                hosts = find_all_hosts_below(graph, node)
-                fltouthosts = string.join(map(lambda x: "not ethDst = %s" % (graph.node[x]['mac']), hosts), " and ")
-                s = string.join((flt, "port = %d" % (k), fltouthosts), " and ")
+        policy = sharded(graph, set_of_tables_for_switches, switches, (False,))
+        edge_policy = sharded(graph, set_of_tables_for_switches, switches, (True,))
+    if withTopo:
+        return program(policy, topology_of_switches(graph, switches),
+                       edge_policy, edge_topology_of_switches(graph, switches))
+    else:
+        return local_program(policy, edge_policy)
+
+def to_netkat_set_of_tables(graph, withTopo=True, factor=False):
+    return to_netkat_set_of_tables_for_switches(graph, graph.switches, withTopo, factor)
+
+def to_netkat_test_set_of_tables(graph, withTopo=True, factor=False):
+    return to_netkat_set_of_tables_for_switches(graph, (graph.switches[0], graph.switches[1], graph.switches[8], graph.switches[9]), withTopo, factor)
+
+def failover_rules(graph, switches, specializeInPort=True, keep=None):
+    '''yields (node, inport, host, outports), as table_rules does, for the
+    failover tables of switches: every entry also sends to a backup port, and
+    the entries of aggregation and core switches are followed by one at the
+    switch below the backup port that sends the traffic up again through a
+    sibling. If keep is given, only the entries for which keep(node,
+    outports) holds are built.'''
+    # switches are numbered level by level: edge, agg, then core
+    for node in sorted(switches):
+        level = graph.level(node)
+        #pprint.pprint(routes_of(graph, node))
+        for k, v in routes_of(graph, node):
+            if not graph.is_host(k):
+                assert level < graph.L
                 v2 = ((v - graph.p) % graph.p) + 1 + graph.p
-                s = string.join((s, "(port := %d + port := %d)" % (v, v2)), "; ")
-                table.append(s)
-        #pprint.pprint(table)
-        policy.extend(table)
-        edge_policy.extend(edge_table)
-
-    # agg
-    for node in graph.agg_switches:
-        if not node in switches:
-            continue
-        table = []
-        flt = "filter switch = %d" % (graph.node[node]['id'])
-        #pprint.pprint(graph.node[node]['routes'])
-        for k, v in graph.node[node]['routes'].iteritems():
-            if k in graph.hosts:
+                if keep is None or keep(node, (v, v2)):
+                    yield node, k, None, (v, v2)
+                continue
+            if level == 0:
+                # host entries of edge switches go to the edge policy
+                continue
+            if level == graph.L:
+                v2 = (v % (2 * graph.p)) + 1
+            else:
                 assert v <= graph.p
+                v2 = (v % graph.p) + 1
 
+            if keep is None or keep(node, (v, v2)):
                 if specializeInPort:
                     for port in range(1, graph.p*2+1):
                         if v == port:
                             continue
-                        s = string.join((flt, "port = %d" % (port), "ethDst = %s" % (graph.node[k]['mac'])), " and ")
-                        v2 = (v % graph.p) + 1
-                        s = string.join((s, "(port := %d + port := %d)" % (v, v2)), "; ")
-                        table.append(s)
+                        yield node, port, k, (v, v2)
                 else:
-                    s = string.join((flt, "ethDst = %s" % (graph.node[k]['mac'])), " and ")
-                    v2 = (v % graph.p) + 1
-                    s = string.join((s, "(port := %d + port := %d)" % (v, v2)), "; ")
-                    table.append(s)
-
-                #print v2
-                reroute = (find_next_node(graph, node, v2))[0]
-                #print reroute
-                ed = graph.get_edge_data(node, reroute)
-                inport = ed['dport']
-
-                nextagg = find_next_sibling_node(graph, reroute, node)
-                #print nextagg
-                ed = graph.get_edge_data(reroute, nextagg)
-                outport = ed['sport']
-
-                s = string.join(("filter switch = %d" % (graph.node[reroute]['id']), "port = %d" % (inport),
-                        "ethDst = %s" % (graph.node[k]['mac'])), " and ")
-                s = string.join((s, "port := %d" % (outport)), "; ")
-                table.append(s)
-            else:
-                hosts = find_all_hosts_below(graph, node)
-                fltouthosts = string.join(map(lambda x: "not ethDst = %s" % (graph.node[x]['mac']), hosts), " and ")
-                s = string.join((flt, "port = %d" % (k), fltouthosts), " and ")
-                v2 = ((v - graph.p) % graph.p) + 1 + graph.p
-                s = string.join((s, "(port := %d + port := %d)" % (v, v2)), "; ")
-                table.append(s)
-
-        #pprint.pprint(table)
-        policy.extend(table)
-
-    # core
-    for node in graph.core_switches:
-        if not node in switches:
-            continue
-        table = []
-        flt = "filter switch = %d" % (graph.node[node]['id'])
-        #pprint.pprint(graph.node[node]['routes'])
-        for k, v in graph.node[node]['routes'].iteritems():
-            assert k in graph.hosts
-
-            if specializeInPort:
-                for port in range(1, graph.p*2+1):
-                    if v == port:
-                        continue
-                    s = string.join((flt, "port = %d" % (port), "ethDst = %s" % (graph.node[k]['mac'])), " and ")
-                    v2 = (v % (2 * graph.p)) + 1
-                    s = string.join((s, "(port := %d + port := %d)" % (v, v2)), "; ")
-                    table.append(s)
-            else:
-                s = string.join((flt, "ethDst = %s" % (graph.node[k]['mac'])), " and ")
-                v2 = (v % (2 * graph.p)) + 1
-                s = string.join((s, "(port := %d + port := %d)" % (v, v2)), "; ")
-                table.append(s)
-
-            #print v2
-            reroute = (find_next_node(graph, node, v2))[0]
-            #print reroute
-            ed = graph.get_edge_data(node, reroute)
-            inport = ed['dport']
-
-            nextcore = find_next_sibling_node(graph, reroute, node)
-            #print nextcore
-            ed = graph.get_edge_data(reroute, nextcore)
-            outport = ed['sport']
-
-            s = string.join(("filter switch = %d" % (graph.node[reroute]['id']), "port = %d" % (inport),
-                    "ethDst = %s" % (graph.node[k]['mac'])), " and ")
-            s = string.join((s, "port := %d" % (outport)), "; ")
-            table.append(s)
-        #pprint.pprint(table)
-        policy.extend(table)
-
+                    yield node, 0, k, (v, v2)
+
+            reroute, inport = find_next_node(graph, node, v2)
+            sibling, outport = find_next_sibling_node(graph, reroute, node)
+            if keep is None or keep(reroute, (outport,)):
+                yield reroute, inport, k, (outport,)
+
+def set_of_tables_failover_for_switches(graph, switches, specializeInPort=True, parts=False):
+    rule = rule_builder(graph, parts)
+    for r in failover_rules(graph, switches, specializeInPort):
+        yield rule(*r)
+
+def to_netkat_set_of_tables_failover_for_switches(graph, switches, withTopo=True, specializeInPort=True, factor=False):
+    edge_switches = [node for node in graph.edge_switches if node in switches]
+    if factor:
+        # the factored terms are parenthesized already
+        policy = factored(graph, set_of_tables_failover_for_switches(graph, switches, specializeInPort, True))
+        edge_policy = factored(graph, set_of_tables_for_switches(graph, edge_switches, True, True))
+    else:
+        policy = (GROUP(r) for r in
+                  sharded(graph, set_of_tables_failover_for_switches, switches, (specializeInPort,)))
+        edge_policy = sharded(graph, set_of_tables_for_switches, edge_switches, (True,))
+        if not withTopo:
+            edge_policy = (GROUP(r) for r in edge_policy)
     if withTopo:
-        topo = []
-        for src, dst, ed in graph.edges_iter(data=True):
-            if src in graph.hosts or dst in graph.hosts:
-                continue
-            if src in switches or dst in switches:
-                topoterm = "%s@%d => %s@%d" % (graph.node[src]['id'], ed['sport'], graph.node[dst]['id'], ed['dport'])
-                topo.append(topoterm)
-
-        edge_topo = []
-        for host in graph.hosts:
-            dst = graph.neighbors(host)[0]
-            if dst in switches:
-                ed = graph.get_edge_data(host, dst)
-                topoterm = "%s@%d => 0@%d" % (graph.node[dst]['id'], ed['dport'], graph.node[host]['id'])
-                edge_topo.append(topoterm)
-
-        return "((\n%s\n);\n(\n%s\n))*;\n((\n%s\n);\n(\n%s\n))" % \
-            (string.join(map(lambda x: "(%s)" % (x), policy), " |\n"), string.join(topo, " |\n"), 
-             string.join(edge_policy, " |\n"), string.join(edge_topo, " |\n"))
+        return program(policy, topology_of_switches(graph, switches),
+                       edge_policy, edge_topology_of_switches(graph, switches))
     else:
-        policy.extend(edge_policy)
-        return "%s\n" % (string.join(map(lambda x: "(%s)" % (x), policy), " |\n"))
-
-def to_netkat_set_of_tables_failover(graph, withTopo=True):
-    return to_netkat_set_of_tables_failover_for_switches(graph, graph.switches, withTopo) 
-
-def to_netkat_test_set_of_tables_failover(graph, withTopo=True):
-    return to_netkat_set_of_tables_failover_for_switches(graph, (graph.switches[0], graph.switches[1], graph.switches[8], graph.switches[9]), withTopo)
+        return local_program(policy, edge_policy)
+
+def to_netkat_set_of_tables_failover(graph, withTopo=True, factor=False):
+    return to_netkat_set_of_tables_failover_for_switches(graph, graph.switches, withTopo, factor=factor)
+
+def to_netkat_test_set_of_tables_failover(graph, withTopo=True, factor=False):
+    return to_netkat_set_of_tables_failover_for_switches(graph, (graph.switches[0], graph.switches[1], graph.switches[8], graph.switches[9]), withTopo, factor=factor)
+
+def failed_ports(graph, links=(), switches=()):
+    '''the set of (node, port) that are down when links ((a, b) node pairs)
+    and switches fail; a failed switch takes down both ends of its links'''
+    stride = 2*graph.p + 1
+    down = set()
+    for a, b in links:
+        found = False
+        for port in range(1, stride):
+            if graph.peer[a*stride + port] == b:
+                down.add((a, port))
+                down.add((b, graph.peer_port[a*stride + port]))
+                found = True
+        if not found:
+            raise ValueError("no link between %s and %s" % (graph.name(a), graph.name(b)))
+    for node in switches:
+        for port in range(1, stride):
+            k = graph.peer[node*stride + port]
+            if k >= 0:
+                down.add((node, port))
+                down.add((k, graph.peer_port[node*stride + port]))
+    return down
+
+def entries_at(graph, nodes, down, failover=True, specializeInPort=True):
+    '''the rules (inport, host, outports) of the switches in nodes that
+    send to a port in down, in rule order. Failover entries at a switch are
+    also generated by the switches above it, so only nodes and their upper
+    neighbors are visited.'''
+    stride = 2*graph.p + 1
+    entries = dict((node, []) for node in nodes)
+    def keep(node, outports):
+        if node not in entries:
+            return False
+        for v in outports:
+            if (node, v) in down:
+                return True
+        return False
+    if failover:
+        switches = set(nodes)
+        for node in nodes:
+            for port in up_ports(graph, node):
+                switches.add(graph.peer[node*stride + port])
+        base = failover_rules(graph, switches, specializeInPort, keep)
+    else:
+        base = table_rules(graph, sorted(nodes), False, keep)
+    edge = [node for node in sorted(nodes) if graph.level(node) == 0]
+    for node, inport, host, outports in itertools.chain(base, table_rules(graph, edge, True, keep)):
+        entries[node].append((inport, host, outports))
+    return entries
+
+def failover_delta(graph, links=(), switches=(), failover=True, specializeInPort=True):
+    '''the changes to the tables when links and switches fail, from the
+    routing state of the whole tree (compute_routes must have run). Returns
+    (rules, topo): rules lists (node, changes) for every switch whose rules
+    change, ordered by node, with changes a list of (old rule, new rule or
+    None if it is removed); topo lists the topology terms that are removed.
+    Only the switches at the end of a failed link are generated, so a sweep
+    over all single failures costs about as much as one full table.'''
+    down = failed_ports(graph, links, switches)
+    nodes = sorted(set(node for node, port in down if not graph.is_host(node)))
+    entries = entries_at(graph, nodes, down, failover, specializeInPort)
+    rule = rule_builder(graph)
+    rules = []
+    for node in nodes:
+        changes = []
+        for inport, host, outports in entries[node]:
+            old = netkat.text(rule(node, inport, host, outports))
+            alive = tuple([v for v in outports if (node, v) not in down])
+            if alive:
+                changes.append((old, netkat.text(rule(node, inport, host, alive))))
+            else:
+                changes.append((old, None))
+        if changes:
+            rules.append((node, changes))
+    topo = []
+    stride = 2*graph.p + 1
+    for node, port in sorted(down):
+        if graph.is_host(node):
+            continue
+        k = graph.peer[node*stride + port]
+        if graph.is_host(k):
+            topo.append(netkat.text(netkat.link(graph.id(node), port, 0, graph.id(k))))
+        else:
+            topo.append(netkat.text(netkat.link(graph.id(node), port, graph.id(k), graph.peer_port[node*stride + port])))
+    return rules, topo
+
+def render_delta(graph, rules, topo):
+    '''yields the lines of a delta: "- old" and "+ new" rules under a
+    "# switch" header per switch, then the removed topology terms'''
+    for node, changes in rules:
+        yield "# switch %d\n" % (graph.id(node))
+        for old, new in changes:
+            yield "- %s\n" % (old)
+            if new is not None:
+                yield "+ %s\n" % (new)
+    if topo:
+        yield "# topology\n"
+        for term in topo:
+            yield "- %s\n" % (term)
+
+def switch_links(graph):
+    '''every link between two switches, once'''
+    for src, dst, sport, dport in graph.edges():
+        if src < dst and not graph.is_host(dst):
+            yield src, dst
+
+def to_netkat_failover_delta(graph, links, switches, failover=True, sweep=False):
+    '''the delta for links and switches failing together, or with sweep, one
+    delta per single switch-to-switch link failure'''
+    if not sweep:
+        rules, topo = failover_delta(graph, links, switches, failover)
+        return render_delta(graph, rules, topo)
+    return itertools.chain.from_iterable(
+        itertools.chain(["## link %s %s\n" % (graph.name(a), graph.name(b))],
+                        render_delta(graph, *failover_delta(graph, [(a, b)], (), failover)))
+        for a, b in switch_links(graph))
 
 def find_next_sibling_node(graph, node, src):
-    for k in graph.neighbors_iter(node):
-        if k in graph.switches and graph.node[k]['level'] == graph.node[src]['level'] and k != src:
-            return k
+    '''the first other neighbor of node on the same side as src, and the port
+    towards it'''
+    if graph.level(src) > graph.level(node):
+        ports = up_ports(graph, node)
+    else:
+        ports = down_ports(graph, node)
+    for port in ports:
+        k = graph.peer[node*(2*graph.p + 1) + port]
+        if k != src:
+            return (k, port)
 
 def find_next_node(graph, node, outport):
-    #print "find_next_node", node, outport
-    for src, dst, ed in graph.edges_iter([node], data=True):
-        assert src == node
-        if graph.node[dst]['type'] == 'host':
-            continue
-        if ed['sport'] == outport:
-            return (dst, ed['dport'])
-
-def find_host(graph, node, outport):
-    for src, dst, ed in graph.edges_iter([node], data=True):
-        assert src == node
-        if graph.node[dst]['type'] != 'host':
-            continue
-        if ed['sport'] == outport:
-            return dst
+    k = graph.peer[node*(2*graph.p + 1) + outport]
+    if k < 0 or graph.is_host(k):
+        return None
+    return (k, graph.peer_port[node*(2*graph.p + 1) + outport])
 
 def find_all_hosts_below(graph, node):
-    hosts = []
-    for k in graph.neighbors_iter(node):
-        if graph.node[k]['type'] == 'host':
-            hosts.append(k)
-        if k in graph.switches and graph.node[k]['level'] < graph.node[node]['level']:
-            hosts.extend(find_all_hosts_below(graph, k))
-    return hosts
-
-def rec_set_of_paths_next_hop(graph, node, inport, dst, srchost, dsthost, switches):
-    path = []
-    flt = "filter switch = %d" % (graph.node[node]['id'])
-    switches.add(node)
-    if node == dst:
-        assert dsthost in graph.node[dst]['routes']
-
-    if dsthost in graph.node[node]['routes']:
-        v = graph.node[node]['routes'][dsthost]
-        path = [string.join((flt, "port := %d" % (v)), "; ")]
-        if node == dst:
-            return ([], path[0])
-    else:
-        assert inport in graph.node[node]['routes']
-        #print "inport", inport
-        v = graph.node[node]['routes'][inport]
-        path = [string.join((flt, "port := %d" % (v)), "; ")]
-
-    nextnode, nextinport = find_next_node(graph, node, v)
-    #print "next", nextnode, nextinport
-    p, edge = rec_set_of_paths_next_hop(graph, nextnode, nextinport, dst, srchost, dsthost, switches)
-    path.extend(p)
-    return path, edge
-
-def to_netkat_set_of_paths_for_hosts(graph, hosts, withTopo=True):
-    policy = []
-    edge_policy = []
-    switches = set()
-    for srchost in hosts:
-        src = graph.neighbors(srchost)[0]
-        nextnode, inport = find_next_node(graph, srchost, 1)
-        assert src == nextnode
+    first, last = graph.hosts_below[node]
+    return range(first, last + 1)
+
+def switch_path(graph, src, inport, dst, dsthost, alternate=False):
+    '''the hops (node, outport, nextnode, nextinport) from src, entered on
+    inport, up to dst. Every switch before dst routes all the hosts below dst
+    the same way, so the result only depends on (src, inport, dst). With
+    alternate, every hop up goes to the next parent instead, which gives a
+    backup path that shares no link or intermediate switch with the primary
+    one.'''
+    hops = []
+    node = src
+    while node != dst:
+        v = route_to_host(graph, node, dsthost)
+        if not v:
+            #print "inport", inport
+            v = route_up(graph, node, inport)
+            assert v
+            if alternate:
+                v = ((v - graph.p) % graph.p) + 1 + graph.p
+        nextnode, nextinport = find_next_node(graph, node, v)
+        #print "next", nextnode, nextinport
+        hops.append((node, v, nextnode, nextinport))
+        node, inport = nextnode, nextinport
+    assert route_to_host(graph, dst, dsthost)
+    return hops
+
+def paths_from_host(graph, srchost, hosts, render, hopcache, switches, backup=False):
+    '''yields (dsthost, dst, path, backuppath) for the paths from srchost,
+    where path is render(graph, hops, hopcache), or None if there are no
+    hops, and dst the edge switch of dsthost.
+    backuppath is the rendered disjoint backup path if backup is set, and
+    None otherwise. The rendered hops are cached by (src edge switch,
+    ingress port, dst edge switch). Only the hosts of one source share an
+    ingress port, so the cache lives for one srchost and holds at most one
+    entry per edge switch; the paths of a source only depend on dst, and
+    the callers keep what they build of them by dst as well. hopcache,
+    where render keeps the hops it built, is the caller's: it holds at most
+    one hop per switch port, and can live for all the sources.'''
+    src, inport = find_next_node(graph, srchost, 1)
+    cache = {}
+    for dsthost in hosts:
+        if srchost == dsthost:
+            continue
+        dst = find_next_node(graph, dsthost, 1)[0]
+        if dst not in cache:
+            hops = switch_path(graph, src, inport, dst, dsthost)
+            switches.update([hop[0] for hop in hops])
+            backuppath = None
+            if backup and hops:
+                backuphops = switch_path(graph, src, inport, dst, dsthost, True)
+                switches.update([hop[0] for hop in backuphops])
+                backuppath = render(graph, backuphops, hopcache)
+            cache[dst] = (render(graph, hops, hopcache) if hops else None, backuppath)
+        switches.add(src)
+        switches.add(dst)
+        path, backuppath = cache[dst]
+        yield dsthost, dst, path, backuppath
+
+def hop_policy(graph, hop, cache, real=False):
+    '''"filter switch = n; port := v" for the hop (node, v, nextnode,
+    nextinport), then its link if real is set, built once per cache'''
+    pol = cache.get(hop)
+    if pol is None:
+        node, v, nextnode, nextinport = hop
+        parts = (switch_filter(graph, node), netkat.mod('port', v))
+        if real:
+            parts += (netkat.link(graph.id(node), v, graph.id(nextnode), nextinport),)
+        pol = cache[hop] = netkat.seq(*parts)
+    return pol
+
+def render_set_of_paths(graph, hops, cache):
+    '''the union of the hops; a term, as only its hops are shared beyond
+    the bodies of one source'''
+    return netkat.term('union', *[hop_policy(graph, hop, cache) for hop in hops])
+
+def set_of_paths_for_hosts(graph, srchosts, hosts, backup, switches):
+    '''yields the paths between hosts, adding the switches they cross to
+    switches; with backup, the hops of the backup path are in the union
+    too'''
+    srcs = host_tests(graph, 'ethSrc')
+    dsts = host_tests(graph, 'ethDst')
+    S = graph.nswitches
+    hopcache = {}
+    for srchost in srchosts:
+        bodies = {}
+        for dsthost, dst, path, backuppath in paths_from_host(graph, srchost, hosts, render_set_of_paths,
+                                                             hopcache, switches, backup):
+            #print "path", srchost, dsthost
+            if dst not in bodies:
+                if backuppath:
+                    bodies[dst] = SPACED_BACKUP(path, backuppath)
+                else:
+                    bodies[dst] = path and SPACED(path)
+            body = bodies[dst]
+            if body:
+                yield PATH(srcs[srchost - S], dsts[dsthost - S], body)
+
+def edge_of_paths_for_hosts(graph, srchosts, hosts):
+    '''yields the last hop of every path; this is what
+    rec_set_of_paths_next_hop returns as edge, without walking the path;
+    the edge of a host does not depend on the source, so it is built once'''
+    srcs = host_tests(graph, 'ethSrc')
+    dsts = host_tests(graph, 'ethDst')
+    S = graph.nswitches
+    edges = {}
+    for dsthost in hosts:
+        dst = find_next_node(graph, dsthost, 1)[0]
+        edges[dsthost] = netkat.seq(switch_filter(graph, dst), netkat.mod('port', route_to_host(graph, dst, dsthost)))
+    for srchost in srchosts:
         for dsthost in hosts:
             if srchost == dsthost:
                 continue
-            dst = graph.neighbors(dsthost)[0]
-            flt = "filter ethSrc = %s; filter ethDst = %s" % (graph.node[srchost]['mac'], graph.node[dsthost]['mac'])
-            #print "path", srchost, dsthost
-            path, edge = rec_set_of_paths_next_hop(graph, src, inport, dst, srchost, dsthost, switches)
-            #print string.join(path, " | ")
-            if len(path) > 0:
-                policy.append("(%s; ( %s ))" % (flt, string.join(path, " | ")))
-            edge_policy.append("(%s; %s)" % (flt, edge))
-            switches.add(src)
-            switches.add(dst)
+            yield PATH(srcs[srchost - S], dsts[dsthost - S], edges[dsthost])
+
+def topology_between_switches(graph, switches):
+    empty = True
+    for src, dst, sport, dport in graph.edges():
+        if graph.is_host(src) or graph.is_host(dst):
+            continue
+        if src not in switches or dst not in switches:
+            continue
+        empty = False
+        yield LINK(graph.id(src), sport, graph.id(dst), dport)
+    if empty:
+        yield netkat.ID
 
+def to_netkat_set_of_paths_for_hosts(graph, hosts, withTopo=True, backup=False):
+    switches = set()
+    policy = sharded(graph, set_of_paths_for_hosts, hosts, (hosts, backup), switches)
+    edge_policy = sharded(graph, edge_of_paths_for_hosts, hosts, (hosts,))
     if withTopo:
-        topo = []
-        for src, dst, ed in graph.edges_iter(data=True):
-            if src in graph.hosts or dst in graph.hosts:
-                continue
-            if src not in switches or dst not in switches:
-                continue
-            topoterm = "%s@%d => %s@%d" % (graph.node[src]['id'], ed['sport'], graph.node[dst]['id'], ed['dport'])
-            topo.append(topoterm)
-        if len(topo) == 0:
-            topo = ["id"]
-
-        edge_topo = []
-        for host in graph.hosts:
-            dst = graph.neighbors(host)[0]
-            if dst in switches:
-                ed = graph.get_edge_data(host, dst)
-                topoterm = "%s@%d => 0@%d" % (graph.node[dst]['id'], ed['dport'], graph.node[host]['id'])
-                edge_topo.append(topoterm)
-
-        return "((\n%s\n);\n(\n%s\n))*;\n((\n%s\n);\n(\n%s\n))" % \
-                (string.join(policy, " |\n"), string.join(topo, " |\n"),
-                 string.join(edge_policy, " |\n"), string.join(edge_topo, " |\n"))
+        # the topology generators run after policy has filled in switches
+        return program(policy, topology_between_switches(graph, switches),
+                       edge_policy, edge_topology_of_switches(graph, switches))
     else:
-        policy.extend(edge_policy)
-        return "%s\n" % (string.join(policy, " |\n"))
+        return local_program(policy, edge_policy)
 
-def to_netkat_set_of_paths(graph, withTopo):
-    return to_netkat_set_of_paths_for_hosts(graph, graph.hosts, withTopo=withTopo)
+def to_netkat_set_of_paths(graph, withTopo, backup=False):
+    return to_netkat_set_of_paths_for_hosts(graph, graph.hosts, withTopo=withTopo, backup=backup)
 
-def to_netkat_test_set_of_paths(graph, withTopo):
-    return to_netkat_set_of_paths_for_hosts(graph, graph.hosts[0:2], withTopo=withTopo)
+def to_netkat_test_set_of_paths(graph, withTopo, backup=False):
+    return to_netkat_set_of_paths_for_hosts(graph, graph.hosts[0:2], withTopo=withTopo, backup=backup)
 
-def to_netkat_test_set_of_paths2(graph, withTopo):
-    return to_netkat_set_of_paths_for_hosts(graph, [graph.hosts[0], graph.hosts[3]], withTopo=withTopo)
+def to_netkat_test_set_of_paths2(graph, withTopo, backup=False):
+    return to_netkat_set_of_paths_for_hosts(graph, [graph.hosts[0], graph.hosts[3]], withTopo=withTopo, backup=backup)
 
 #########
 #REAL_PATHS
 #########
-def rec_real_paths_next_hop(graph, node, inport, dst, srchost, dsthost, switches):
-    path = []
-    flt = "filter switch = %d" % (graph.node[node]['id'])
-    switches.add(node)
-    if node == dst:
-        return []
-
-    if dsthost in graph.node[node]['routes']:
-        v = graph.node[node]['routes'][dsthost]
-        s = string.join((flt, "port := %d" % (v)), "; ")
-    else:
-        assert inport in graph.node[node]['routes']
-        #print "inport", inport
-        v = graph.node[node]['routes'][inport]
-        s = string.join((flt, "port := %d" % (v)), "; ")
-
-    nextnode, nextinport = find_next_node(graph, node, v)
-    ed = graph.get_edge_data(node, nextnode)
-    topoterm = "%s@%d => %d@%d" % (graph.node[node]['id'], v, graph.node[nextnode]['id'], ed['dport'])
-    path = [s + "; " + topoterm]
-    #print "next", nextnode, nextinport
-    if nextnode != dst:
-        p = rec_real_paths_next_hop(graph, nextnode, nextinport, dst, srchost, dsthost, switches)
-        path.extend(p)
-    return path
-
-def to_netkat_real_paths_for_hosts(graph, hosts, withTopo=True):
-    policy = ["id"]
-    edge_policy = []
-    switches = set()
-    for srchost in hosts:
-        src = graph.neighbors(srchost)[0]
-        nextnode, inport = find_next_node(graph, srchost, 1)
-        assert src == nextnode
-        for dsthost in hosts:
-            if srchost == dsthost:
-                continue
-            dst = graph.neighbors(dsthost)[0]
-            flt = "filter ethSrc = %s; filter ethDst = %s" % (graph.node[srchost]['mac'], graph.node[dsthost]['mac'])
+def render_real_paths(graph, hops, cache):
+    '''the hops with their links, in sequence; a term, as only its hops are
+    shared beyond the bodies of one source'''
+    pols = [hop_policy(graph, hop, cache, True) for hop in hops]
+    return netkat.term('seq', *pols) if pols else netkat.ID
+
+def real_paths_for_hosts(graph, srchosts, hosts, backup, switches):
+    srcs = host_tests(graph, 'ethSrc')
+    dsts = host_tests(graph, 'ethDst')
+    S = graph.nswitches
+    hopcache = {}
+    for srchost in srchosts:
+        bodies = {}
+        for dsthost, dst, path, backuppath in paths_from_host(graph, srchost, hosts, render_real_paths,
+                                                             hopcache, switches, backup):
             #print "path", srchost, dsthost
-            path = rec_real_paths_next_hop(graph, src, inport, dst, srchost, dsthost, switches)
-            #print string.join(path, " | ")
-            if len(path) > 0:
-                policy.append("(%s; %s)" % (flt, string.join(path, "; ")))
-            switches.add(src)
-            switches.add(dst)
-
-    # edge
+            if backuppath:
+                if dst not in bodies:
+                    bodies[dst] = BACKUP(path, backuppath)
+                path = bodies[dst]
+            if path:
+                yield PATH(srcs[srchost - S], dsts[dsthost - S], path)
+
+def edge_tables(graph):
+    dsts = host_tests(graph, 'ethDst')
     for node in graph.edge_switches:
-        edge_table = []
-        flt = "filter switch = %d" % (graph.node[node]['id'])
-        #pprint.pprint(graph.node[node]['routes'])
-        for k, v in graph.node[node]['routes'].iteritems():
-            if k in graph.hosts:
-                s = string.join((flt, "filter ethDst = %s" % (graph.node[k]['mac']), "port := %d" % (v)), "; ")
-                edge_table.append(s)
-        edge_policy.extend(edge_table)
+        flt = switch_filter(graph, node)
+        #pprint.pprint(routes_of(graph, node))
+        for k, v in routes_of(graph, node):
+            if graph.is_host(k):
+                yield HOST_RULE(flt, dsts[k - graph.nswitches], netkat.mod('port', v))
 
+def to_netkat_real_paths_for_hosts(graph, hosts, withTopo=True, backup=False):
+    switches = set()
+    policy = itertools.chain([netkat.ID], sharded(graph, real_paths_for_hosts, hosts, (hosts, backup), switches))
+    edge_policy = edge_tables(graph)
     if withTopo:
-        edge_topo = []
-        for host in graph.hosts:
-            dst = graph.neighbors(host)[0]
-            if dst in switches:
-                ed = graph.get_edge_data(host, dst)
-                topoterm = "%s@%d => 0@%d" % (graph.node[dst]['id'], ed['dport'], graph.node[host]['id'])
-                edge_topo.append(topoterm)
-
-        return "(\n%s\n);\n((\n%s\n);\n(\n%s\n))" % \
-                (string.join(policy, " |\n"),
-                 string.join(edge_policy, " |\n"), string.join(edge_topo, " |\n"))
+        edge_topo = edge_topology_of_switches(graph, switches)
+        return netkat.seq(netkat.group(netkat.stream(policy)), pair(edge_policy, edge_topo))
     else:
-        policy.extend(edge_policy)
-        return "%s\n" % (string.join(policy, " |\n"))
+        return local_program(policy, edge_policy)
 
-def to_netkat_real_paths(graph, withTopo):
-    return to_netkat_real_paths_for_hosts(graph, graph.hosts, withTopo=withTopo)
+def to_netkat_real_paths(graph, withTopo, backup=False):
+    return to_netkat_real_paths_for_hosts(graph, graph.hosts, withTopo=withTopo, backup=backup)
 
-def to_netkat_test_real_paths(graph, withTopo):
-    return to_netkat_real_paths_for_hosts(graph, graph.hosts[0:2], withTopo=withTopo)
+def to_netkat_test_real_paths(graph, withTopo, backup=False):
+    return to_netkat_real_paths_for_hosts(graph, graph.hosts[0:2], withTopo=withTopo, backup=backup)
 
-def to_netkat_test_real_paths2(graph, withTopo):
-    return to_netkat_real_paths_for_hosts(graph, [graph.hosts[0], graph.hosts[3]], withTopo=withTopo)
+def to_netkat_test_real_paths2(graph, withTopo, backup=False):
+    return to_netkat_real_paths_for_hosts(graph, [graph.hosts[0], graph.hosts[3]], withTopo=withTopo, backup=backup)
 
 #########
 #REAL_PATHS_NO_ID
 #########
-def rec_realnoid_paths_next_hop(graph, node, inport, dst, srchost, dsthost, switches):
-    path = []
-    flt = "filter switch = %d" % (graph.node[node]['id'])
-    switches.add(node)
-    if node == dst:
-        assert dsthost in graph.node[dst]['routes']
-
-    if dsthost in graph.node[node]['routes']:
-        v = graph.node[node]['routes'][dsthost]
-        s = string.join((flt, "port := %d" % (v)), "; ")
-        if node == dst:
-            topoterm = "%s@%d => 0@%d" % (graph.node[node]['id'], v, graph.node[dsthost]['id'])
-            return [s + "; " + topoterm]
-    else:
-        assert inport in graph.node[node]['routes']
-        #print "inport", inport
-        v = graph.node[node]['routes'][inport]
-        s = string.join((flt, "port := %d" % (v)), "; ")
-
-    nextnode, nextinport = find_next_node(graph, node, v)
-    ed = graph.get_edge_data(node, nextnode)
-    topoterm = "%s@%d => %d@%d" % (graph.node[node]['id'], v, graph.node[nextnode]['id'], ed['dport'])
-    path = [s + "; " + topoterm]
-    #print "next", nextnode, nextinport
-    p = rec_realnoid_paths_next_hop(graph, nextnode, nextinport, dst, srchost, dsthost, switches)
-    path.extend(p)
-    return path
-
-def to_netkat_realnoid_paths_for_hosts(graph, hosts, withTopo=True):
-    policy = []
-    switches = set()
-    for srchost in hosts:
-        src = graph.neighbors(srchost)[0]
-        nextnode, inport = find_next_node(graph, srchost, 1)
-        assert src == nextnode
-        for dsthost in hosts:
-            if srchost == dsthost:
-                continue
-            dst = graph.neighbors(dsthost)[0]
-            flt = "filter ethSrc = %s; filter ethDst = %s" % (graph.node[srchost]['mac'], graph.node[dsthost]['mac'])
+def realnoid_paths_for_hosts(graph, srchosts, hosts, backup, switches):
+    '''yields the paths between hosts, each with its last hop; the last hop
+    of a host is built once'''
+    srcs = host_tests(graph, 'ethSrc')
+    dsts = host_tests(graph, 'ethDst')
+    S = graph.nswitches
+    lasts = {}
+    hopcache = {}
+    for srchost in srchosts:
+        bodies = {}
+        for dsthost, dst, path, backuppath in paths_from_host(graph, srchost, hosts, render_real_paths,
+                                                             hopcache, switches, backup):
             #print "path", srchost, dsthost
-            path = rec_realnoid_paths_next_hop(graph, src, inport, dst, srchost, dsthost, switches)
-            #print string.join(path, " | ")
-            if len(path) > 0:
-                policy.append("(%s; %s)" % (flt, string.join(path, "; ")))
-            switches.add(src)
-            switches.add(dst)
+            last = lasts.get(dsthost)
+            if last is None:
+                v = route_to_host(graph, dst, dsthost)
+                last = lasts[dsthost] = netkat.seq(switch_filter(graph, dst), netkat.mod('port', v),
+                                                   netkat.link(graph.id(dst), v, 0, graph.id(dsthost)))
+            if backuppath:
+                if dst not in bodies:
+                    bodies[dst] = BACKUP(path, backuppath)
+                path = bodies[dst]
+            if path:
+                yield PATH_LAST(srcs[srchost - S], dsts[dsthost - S], path, last)
+            else:
+                yield PATH(srcs[srchost - S], dsts[dsthost - S], last)
 
-    return "%s\n" % (string.join(policy, " |\n"))
+def to_netkat_realnoid_paths_for_hosts(graph, hosts, withTopo=True, backup=False):
+    return local_program(sharded(graph, realnoid_paths_for_hosts, hosts, (hosts, backup), set()), [])
 
-def to_netkat_realnoid_paths(graph, withTopo):
-    return to_netkat_realnoid_paths_for_hosts(graph, graph.hosts, withTopo=withTopo)
+def to_netkat_realnoid_paths(graph, withTopo, backup=False):
+    return to_netkat_realnoid_paths_for_hosts(graph, graph.hosts, withTopo=withTopo, backup=backup)
 
-def to_netkat_test_realnoid_paths(graph, withTopo):
-    return to_netkat_realnoid_paths_for_hosts(graph, graph.hosts[0:2], withTopo=withTopo)
+def to_netkat_test_realnoid_paths(graph, withTopo, backup=False):
+    return to_netkat_realnoid_paths_for_hosts(graph, graph.hosts[0:2], withTopo=withTopo, backup=backup)
 
-def to_netkat_test_realnoid_paths2(graph, withTopo):
-    return to_netkat_realnoid_paths_for_hosts(graph, [graph.hosts[0], graph.hosts[3]], withTopo=withTopo)
+def to_netkat_test_realnoid_paths2(graph, withTopo, backup=False):
+    return to_netkat_realnoid_paths_for_hosts(graph, [graph.hosts[0], graph.hosts[3]], withTopo=withTopo, backup=backup)
 
 #########
 
-def to_netkat_regular(graph, withTopo=True):
-    # succinct program that exploits regularity
-    policy = []
-
+def regular_policy(graph):
     core_flt = []
     for sw in graph.core_switches:
-        flt = "filter switch = %d" % (graph.node[sw]['id'])
-        core_flt.append(flt)
+        core_flt.append(switch_filter(graph, sw))
 
     core_policy = []
+    dsts = host_tests(graph, 'ethDst')
     for host in graph.hosts:
-        port = ((int(host[1:]) - 1) / (2*graph.p)) + 1
-        s = string.join(("filter ethDst = %s" % (graph.node[host]['mac']), "port := %d" % (port)), "; ")
-        core_policy.append(s)
+        port = ((graph.id(host) - 1) / (2*graph.p)) + 1
+        core_policy.append(netkat.seq(netkat.filter(dsts[host - graph.nswitches]), netkat.mod('port', port)))
 
-    policy.append("((%s); (%s))" % (string.join(core_flt, " | "), string.join(core_policy, " | ")))
+    graph.rules += len(core_policy)
+    yield tables_of_switches(core_flt, core_policy)
 
     agg_flt = []
     for sw in graph.agg_switches:
-        flt = "filter switch = %d" % (graph.node[sw]['id'])
-        agg_flt.append(flt)
+        agg_flt.append(switch_filter(graph, sw))
 
     agg_policy = []
     # every agg sw has the same port-based filters; use the first
     sw = graph.agg_switches[0]
-    for k, v in graph.node[sw]['routes'].iteritems():
-        if isinstance(k, int):
-            s = string.join(("filter port = %d" % (k), "port := %d" % (v)), "; ")
-            agg_policy.append(s)
+    for k, v in routes_of(graph, sw):
+        if not graph.is_host(k):
+            agg_policy.append(netkat.seq(netkat.filter(netkat.test('port', k)), netkat.mod('port', v)))
 
-    policy.append("((%s); (%s))" % (string.join(agg_flt, " | "), string.join(agg_policy, " | ")))
+    graph.rules += len(agg_policy)
+    yield tables_of_switches(agg_flt, agg_policy)
 
     edge_flt = []
     for sw in graph.edge_switches:
-        flt = "filter switch = %d" % (graph.node[sw]['id'])
-        edge_flt.append(flt)
+        edge_flt.append(switch_filter(graph, sw))
 
     edge_policy = []
     # every agg sw has the same port-based filters; use the first
     sw = graph.edge_switches[0]
-    for k, v in graph.node[sw]['routes'].iteritems():
-        if isinstance(k, int):
-            s = string.join(("filter port = %d" % (k), "port := %d" % (v)), "; ")
-            edge_policy.append(s)
+    for k, v in routes_of(graph, sw):
+        if not graph.is_host(k):
+            edge_policy.append(netkat.seq(netkat.filter(netkat.test('port', k)), netkat.mod('port', v)))
 
-    policy.append("((%s); (%s))" % (string.join(edge_flt, " | "), string.join(edge_policy, " | ")))
+    graph.rules += len(edge_policy)
+    yield tables_of_switches(edge_flt, edge_policy)
 
-    agg_policy = []
-    for sw in graph.agg_switches:
-        flt = "filter switch = %d" % (graph.node[sw]['id'])
-        for k, v in graph.node[sw]['routes'].iteritems():
-            if k in graph.hosts:
-                s = string.join((flt, "filter ethDst = %s" % (graph.node[k]['mac']), "port := %d" % (v)), "; ")
-                agg_policy.append("(%s)" % (s))
+    for s in sharded(graph, regular_host_tables, graph.agg_switches):
+        yield s
 
-    policy.extend(agg_policy)
-
-    # every agg sw has the same port-based filters; use the first
-    edge_policy = []
-    for sw in graph.edge_switches:
-        flt = "filter switch = %d" % (graph.node[sw]['id'])
-        for k, v in graph.node[sw]['routes'].iteritems():
-            if k in graph.hosts:
-                s = string.join((flt, "filter ethDst = %s" % (graph.node[k]['mac']), "port := %d" % (v)), "; ")
-                edge_policy.append("(%s)" % (s))
+def regular_host_tables(graph, switches):
+    dsts = host_tests(graph, 'ethDst')
+    for sw in switches:
+        flt = switch_filter(graph, sw)
+        for k, v in routes_of(graph, sw):
+            if graph.is_host(k):
+                yield GROUP(HOST_RULE(flt, dsts[k - graph.nswitches], netkat.mod('port', v)))
 
+def to_netkat_regular(graph, withTopo=True):
+    # succinct program that exploits regularity
+    policy = regular_policy(graph)
+    edge_policy = sharded(graph, regular_host_tables, graph.edge_switches)
     if withTopo:
-        topo = []
-        for src, dst, ed in graph.edges_iter(data=True):
-            if src in graph.hosts or dst in graph.hosts:
-                continue
-            topoterm = "%s@%d => %s@%d" % (graph.node[src]['id'], ed['sport'], graph.node[dst]['id'], ed['dport'])
-            topo.append(topoterm)
+        switches = set(graph.switches)
+        return program(policy, topology_of_switches(graph, switches),
+                       edge_policy, edge_topology_of_switches(graph, switches))
+    else:
+        return local_program(policy, edge_policy)
 
-        edge_topo = []
-        for host in graph.hosts:
-            dst = graph.neighbors(host)[0]
-            ed = graph.get_edge_data(host, dst)
-            topoterm = "%s@%d => 0@%d" % (graph.node[dst]['id'], ed['dport'], graph.node[host]['id'])
-            edge_topo.append(topoterm)
+_shard_graph = None
 
-    if withTopo:
-        return "((\n%s\n);\n(\n%s\n))*;\n((\n%s\n);\n(\n%s\n))" % \
-            (string.join(policy, " |\n"), string.join(topo, " |\n"),
-             string.join(edge_policy, " |\n"), string.join(edge_topo, " |\n"))
+def write_shard(args):
+    '''worker side of sharded(): writes the terms of one slice to path, one
+    per line, and returns the switches the slice collected. The text of a
+    term never has a newline, so merge_shards and merged_section read a
+    term back from every line.'''
+    fn, part, fnargs, path, collect = args
+    switches = set()
+    if collect:
+        fnargs = fnargs + (switches,)
+    with open(path, 'w') as f:
+        netkat.write_chunks(("%s\n" % (netkat.text(term)) for term in fn(_shard_graph, part, *fnargs)), f)
+    return switches
+
+def merge_shards(graph, fn, items, args, switches):
+    import multiprocessing
+    import shutil
+    import tempfile
+    global _shard_graph
+    jobs = graph.jobs
+    nparts = min(len(items), jobs * 4)
+    bounds = [len(items) * i / nparts for i in range(nparts + 1)]
+    tmpdir = tempfile.mkdtemp(prefix='abfattree')
+    tasks = [(fn, items[bounds[i]:bounds[i+1]], args, os.path.join(tmpdir, "shard%d" % (i)),
+              switches is not None) for i in range(nparts)]
+    _shard_graph = graph
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for task, collected in itertools.izip(tasks, pool.imap(write_shard, tasks)):
+            if switches is not None:
+                switches.update(collected)
+            with open(task[3]) as f:
+                for line in f:
+                    yield line[:-1]
+            os.remove(task[3])
+        pool.close()
+        pool.join()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+def shard_section(graph, fn, items, args, switches):
+    '''--shard side of sharded(): yields the terms of this shard's slice of
+    items and writes them to graph.shardfile as the next section, one per
+    line as write_shard does'''
+    i, n = graph.shard
+    part = items[len(items) * i / n:len(items) * (i + 1) / n]
+    section = graph.sections
+    graph.sections += 1
+    f = graph.shardfile
+    f.write("# section %d\n" % (section))
+    collected = set()
+    if getattr(graph, 'jobs', 1) > 1 and len(part) >= 2:
+        terms = merge_shards(graph, fn, part, args, collected if switches is not None else None)
+    elif switches is not None:
+        terms = fn(graph, part, *(args + (collected,)))
+    else:
+        terms = fn(graph, part, *args)
+    for term in terms:
+        f.write("%s\n" % (netkat.text(term)))
+        yield term
+    f.write("# end %d %s\n" % (section, string.join(map(str, sorted(collected)), " ")))
+    if switches is not None:
+        switches.update(collected)
+
+def merged_section(graph, switches):
+    '''--merge side of sharded(): yields the terms of the next section of
+    every file of graph.merge, in shard order, and adds the switches they
+    collected to switches'''
+    section = graph.sections
+    graph.sections += 1
+    for f in graph.merge:
+        line = next(f, None)
+        if line != "# section %d\n" % (section):
+            raise ValueError("%s: expected section %d, got %r" % (f.name, section, line))
+        for line in f:
+            if line.startswith("# end "):
+                break
+            yield line[:-1]
+        else:
+            raise ValueError("%s: section %d is truncated" % (f.name, section))
+        if switches is not None:
+            switches.update(map(int, line.split()[3:]))
+
+def sharded(graph, fn, items, args=(), switches=None):
+    '''lazily yields the terms of fn(graph, items, *args), with switches as
+    the last argument if it is given. With graph.jobs > 1, items are split in
+    contiguous slices that run in worker processes, and the terms come back as
+    their text, in the order of a sequential run; the switches collected by
+    the workers are added to switches before their terms are yielded. With
+    graph.shard, only the terms of one slice of items are built and also
+    written to the shard file; with graph.merge, the text of the terms is read
+    back from the shard files.
+    The workers are forked once graph is in _shard_graph, so they share its
+    routing state instead of being sent a copy, and a slice that fails
+    raises in the parent. The terms are rules or paths, and are counted in
+    graph.rules as they are yielded.'''
+    if getattr(graph, 'shard', None) is not None:
+        terms = shard_section(graph, fn, list(items), args, switches)
+    elif getattr(graph, 'merge', None) is not None:
+        terms = merged_section(graph, switches)
+    elif getattr(graph, 'jobs', 1) <= 1 or len(items) < 2:
+        if switches is not None:
+            args = args + (switches,)
+        terms = fn(graph, items, *args)
     else:
-        policy.extend(edge_policy)
-        return "%s\n" % (string.join(policy, " |\n"))
+        terms = merge_shards(graph, fn, list(items), args, switches)
+    return counted(graph, terms)
 
+def counted(graph, terms):
+    for term in terms:
+        graph.rules += 1
+        yield term
 
-def to_netkat(graph, kattype, katfile, failover, local):
-    for node in graph.switches:
-        graph.node[node]['routes'] = {}
-        l = (graph.node[node]['id'] - 1) / (2*graph.p**graph.L)
-        graph.node[node]['level'] = l
-    for node in graph.hosts:
-        rec_routing_downwards(graph, node, node, 0)
-    n = len(graph.switches) - graph.p**graph.L
-    noncore_switches = graph.switches[0:n]
-    for node in noncore_switches:
-        routing_upwards(graph, node)
-    #print nx.to_agraph(graph)
+
+def flow_rules(graph, switches, failover):
+    '''yields the rules of the tables policy of switches for
+    flowtable.write_tables; a MAC as an integer is the id of its host'''
+    if failover:
+        edge_switches = [node for node in graph.edge_switches if node in switches]
+        rules = itertools.chain(failover_rules(graph, switches),
+                                table_rules(graph, edge_switches, True))
+    else:
+        rules = itertools.chain(table_rules(graph, switches, False),
+                                table_rules(graph, switches, True))
+    for node, inport, host, outports in rules:
+        if host is None:
+            first, last = graph.hosts_below[node]
+            yield graph.id(node), inport, True, graph.id(first), graph.id(last), outports
+        else:
+            yield graph.id(node), inport, False, graph.id(host), graph.id(host), outports
+
+def to_flow_tables(graph, kattype, f, failover):
+    '''writes the tables of -t tables or testtables to f in the binary
+    format of flowtable.py'''
+    if kattype == 'tables':
+        switches = graph.switches
+    else:
+        switches = (graph.switches[0], graph.switches[1], graph.switches[8], graph.switches[9])
+    flowtable.write_tables(f, graph.nswitches, flow_rules(graph, switches, failover))
+
+
+def shard_config(graph, kattype, failover, local):
+    '''the options a shard was generated with, which all shards of a policy
+    share'''
+    return {'fanout': 2 * graph.p, 'depth': graph.L + 1, 'kattype': kattype,
+            'failover': failover, 'local': local, 'prefixes': graph.prefixes}
+
+def to_netkat_shard(graph, kattype, f, failover, local, shard, jobs=1, profile=None):
+    '''writes shard (i, n) of the policy to f: a header, then the terms of
+    the slice i of every list of switches or hosts the policy is split on.
+    The policy text itself is dropped; mergeshards.py puts it back together
+    from the files of all n shards.'''
+    f.write("# abfattree shard %d/%d %s\n" % (shard[0], shard[1],
+                                              json.dumps(shard_config(graph, kattype, failover, local), sort_keys=True)))
+    graph.shard = shard
+    graph.shardfile = f
+    graph.sections = 0
+    to_netkat(graph, kattype, os.devnull, failover, local, jobs, profile)
+
+def read_shard_header(f):
+    '''returns (i, n, config) from the header of a file of to_netkat_shard'''
+    line = next(f, "")
+    fields = line.split(" ", 4)
+    if len(fields) != 5 or fields[:3] != ['#', 'abfattree', 'shard']:
+        raise ValueError("%s is not an abfattree shard" % (f.name))
+    i, n = map(int, fields[3].split("/"))
+    return i, n, json.loads(fields[4])
+
+
+# helpers counted by --profile
+HOT = ['find_next_node', 'find_next_sibling_node', 'find_all_hosts_below',
+       'not_hosts_below_filter', 'switch_path', 'paths_from_host']
+
+# the writers of a policy, by --format
+BACKENDS = {'text': netkat.write_text, 'binary': netkat.write_binary}
+
+def to_netkat(graph, kattype, katfile, failover, local, jobs=1, profile=None, factor=False, backend='text'):
+    if profile is None:
+        profile = profiling.Profile(False)
+    # the routes of a graph are computed once, for every policy of it
+    if getattr(graph, 'down', None) is None:
+        with profile.phase('routing'):
+            compute_routes(graph)
     withTopo = not local
+    graph.jobs = jobs
+    # the rules (paths for the path types) of the policy, as it is written
+    graph.rules = 0
     if failover:
         if kattype == 'tables':
-            policy = to_netkat_set_of_tables_failover(graph, withTopo=withTopo)
+            policy = to_netkat_set_of_tables_failover(graph, withTopo=withTopo, factor=factor)
         elif kattype == 'testtables':
-            policy = to_netkat_test_set_of_tables_failover(graph, withTopo=withTopo)
+            policy = to_netkat_test_set_of_tables_failover(graph, withTopo=withTopo, factor=factor)
+        # the path types add a disjoint backup path to every path
+        elif kattype == 'paths':
+            policy = to_netkat_set_of_paths(graph, withTopo=withTopo, backup=True)
+        elif kattype == 'testpaths':
+            policy = to_netkat_test_set_of_paths(graph, withTopo=withTopo, backup=True)
+        elif kattype == 'testpaths2':
+            policy = to_netkat_test_set_of_paths2(graph, withTopo=withTopo, backup=True)
+        elif kattype == 'realpaths':
+            policy = to_netkat_real_paths(graph, withTopo=withTopo, backup=True)
+        elif kattype == 'testrealpaths':
+            policy = to_netkat_test_real_paths(graph, withTopo=withTopo, backup=True)
+        elif kattype == 'testrealpaths2':
+            policy = to_netkat_test_real_paths2(graph, withTopo=withTopo, backup=True)
+        elif kattype == 'realnoidpaths':
+            policy = to_netkat_realnoid_paths(graph, withTopo=withTopo, backup=True)
+        elif kattype == 'testnoidrealpaths':
+            policy = to_netkat_test_realnoid_paths(graph, withTopo=withTopo, backup=True)
+        elif kattype == 'testnoidrealpaths2':
+            policy = to_netkat_test_realnoid_paths2(graph, withTopo=withTopo, backup=True)
         else:
             raise "Unsupported"
     else:
         if kattype == 'tables':
-            policy = to_netkat_set_of_tables(graph, withTopo=withTopo)
+            policy = to_netkat_set_of_tables(graph, withTopo=withTopo, factor=factor)
         elif kattype == 'testtables':
-            policy = to_netkat_test_set_of_tables(graph, withTopo=withTopo)
+            policy = to_netkat_test_set_of_tables(graph, withTopo=withTopo, factor=factor)
         elif kattype == 'paths':
             policy = to_netkat_set_of_paths(graph, withTopo=withTopo)
         elif kattype == 'testpaths':
@@ -722,11 +1243,25 @@ def to_netkat(graph, kattype, katfile, failover, local):
         else:
             raise "Unsupported"
 
-    if katfile:
-        with open(katfile, 'w') as f:
-            f.write(policy)
-    else:
-        print policy
+    # the policy is generated lazily, so 'policy' includes 'write'
+    write = BACKENDS[backend]
+    with profile.phase('policy'):
+        if katfile:
+            with open(katfile, 'wb') as f:
+                write(policy, profile.timed(f, 'write'))
+        else:
+            write(policy, profile.timed(sys.stdout, 'write'))
+            if backend == 'text':
+                print
+
+def parse_shard(s):
+    try:
+        i, n = map(int, s.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected i/N, got %r" % (s))
+    if not 0 <= i < n:
+        raise argparse.ArgumentTypeError("shard %d is not in 0..%d" % (i, n - 1))
+    return i, n
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -737,6 +1272,8 @@ def parse_args():
     parser.add_argument("-o", "--out", dest='output', action='store',
                         default=None,
                         help='file to write to')
+    parser.add_argument("-n", "--no-topo", dest='notopo', action='store_true',
+                        help='do not write the topology in DOT')
     parser.add_argument("-k", "--kat", dest='katfile', action='store',
                         default=None,
                         help='file to write to')
@@ -750,23 +1287,120 @@ def parse_args():
 						type = str,
                         choices=['full', 'local'],
                         help='output local')
+    parser.add_argument("-j", "--jobs", dest='jobs', action='store',
+                        default=1,
+                        type=int,
+                        help='number of worker processes for the KAT policy')
     parser.add_argument("-t", "--type",
                         help='KAT policy type',
                         dest='kattype',
                         action='store',
-                        choices=['tables', 'paths', 'regular', 'realpaths', 'realnoidpaths', 'testpaths', 'testpaths2', 'testrealpaths', 'testrealpaths2', 'testnoidrealpaths', 'testnoidrealpaths2', 'testtables'],
+                        choices=KATTYPES,
                         default='tables',
                         type=str)
+    parser.add_argument("--factor", dest='factor', action='store_true',
+                        help='write every distinct switch table once, for all the switches that have it (tables types)')
+    parser.add_argument("-b", "--binary", dest='binary', action='store',
+                        default=None,
+                        help='file to write the tables of -t tables or testtables to in the binary format of flowtable.py; NetKAT is then only written with -k')
+    parser.add_argument("--prefixes", dest='prefixes', action='store_true',
+                        help='match the hosts below a switch in up-port rules by ip4Dst prefixes instead of one ethDst each; this is the same policy only for IP packets whose ip4Dst is the IP of the host of their ethDst')
+    parser.add_argument("--format", dest='format', action='store',
+                        choices=sorted(BACKENDS), default='text',
+                        help='write the KAT policy as NetKAT text, or as the nodes of netkat.py in its binary format')
+    parser.add_argument("--shard", dest='shard', action='store',
+                        type=parse_shard, default=None,
+                        help='i/N: only build shard i (0..N-1) of the policy, split by switch or source host, for mergeshards.py; without -k, it goes to stdout and implies -n unless -o is given')
+    parser.add_argument("--fail-link", dest='faillinks', action='append',
+                        nargs=2, metavar=('A', 'B'), default=[],
+                        help='write only the changes to the tables when the link between nodes A and B (e.g. s1 s9) fails')
+    parser.add_argument("--fail-switch", dest='failswitches', action='append',
+                        metavar='S', default=[],
+                        help='write only the changes to the tables when switch S fails')
+    parser.add_argument("--fail-sweep", dest='failsweep', action='store_true',
+                        help='write the changes to the tables for every single switch link failure')
+    parser.add_argument("--profile", dest='profile', action='store',
+                        nargs='?', const='table', default=None,
+                        choices=['table', 'json'],
+                        help='print per-phase timings and call counts to stderr')
+    parser.add_argument("--pstats", dest='pstats', action='store',
+                        default=None,
+                        help='run under cProfile and dump the stats to this file')
+    parser.add_argument("--count", dest='count', action='store_true',
+                        help='write the number of rules of the KAT policy, or of paths for the path types, to stderr')
 
-    return parser.parse_args()
+    return parser, parser.parse_args()
 
 
 if __name__ == "__main__":
-    args = parse_args()
-    graph = generate(args.fanout, args.depth)
-
-    if args.output:
-        nx.write_dot(graph,args.output)
+    parser, args = parse_args()
+    profile = profiling.Profile(args.profile is not None, args.pstats)
+    profile.count_calls(globals(), HOT)
+    profile.start()
+    with profile.phase('generate'):
+        graph = generate(args.fanout, args.depth)
+    graph.prefixes = args.prefixes
+
+    if args.shard and not args.katfile and not args.output:
+        # the shard goes to stdout, which mergeshards.py reads whole
+        args.notopo = True
+    if not args.notopo:
+        with profile.phase('dot'):
+            if args.output:
+                with open(args.output, 'w') as f:
+                    graph.write_dot(f)
+            else:
+                graph.write_dot(sys.stdout)
+    if args.factor and args.kattype not in ('tables', 'testtables'):
+        print >> sys.stderr, "--factor is only supported for -t tables and testtables"
+        exit(1)
+    if args.binary and args.kattype not in ('tables', 'testtables'):
+        print >> sys.stderr, "--binary is only supported for -t tables and testtables"
+        exit(1)
+    if args.shard and (args.factor or args.binary or args.faillinks or args.failswitches or args.failsweep):
+        print >> sys.stderr, "--shard does not support --factor, --binary or failure deltas"
+        exit(1)
+    if args.format != 'text' and (args.shard or args.jobs > 1 or args.faillinks or args.failswitches or args.failsweep):
+        # workers, shards and deltas only pass on the text of the terms
+        print >> sys.stderr, "--format %s does not support -j, --shard or failure deltas" % (args.format)
+        exit(1)
+    if args.shard:
+        if args.katfile:
+            with open(args.katfile, 'w') as f:
+                to_netkat_shard(graph, args.kattype, f, args.failover == 'fail', args.local == 'local', args.shard,
+                                args.jobs, profile)
+        else:
+            to_netkat_shard(graph, args.kattype, sys.stdout, args.failover == 'fail', args.local == 'local',
+                            args.shard, args.jobs, profile)
+    elif args.faillinks or args.failswitches or args.failsweep:
+        if args.kattype != 'tables':
+            print >> sys.stderr, "Failure deltas are only supported for -t tables"
+            exit(1)
+        with profile.phase('routing'):
+            compute_routes(graph)
+        try:
+            links = [(graph.node(a), graph.node(b)) for a, b in args.faillinks]
+            switches = [graph.node(name) for name in args.failswitches]
+            delta = to_netkat_failover_delta(graph, links, switches, args.failover == 'fail', args.failsweep)
+        except ValueError as e:
+            parser.error(str(e))
+        with profile.phase('delta'):
+            if args.katfile:
+                with open(args.katfile, 'w') as f:
+                    netkat.write_chunks(delta, f)
+            else:
+                netkat.write_chunks(delta, sys.stdout)
     else:
-        print nx.to_agraph(graph)
-    to_netkat(graph, args.kattype, args.katfile, args.failover == 'fail', args.local == 'local')
+        if args.katfile or not args.binary:
+            to_netkat(graph, args.kattype, args.katfile, args.failover == 'fail', args.local == 'local', args.jobs,
+                      profile, args.factor, args.format)
+        else:
+            with profile.phase('routing'):
+                compute_routes(graph)
+        if args.binary:
+            with profile.phase('binary'):
+                with open(args.binary, 'wb') as f:
+                    to_flow_tables(graph, args.kattype, f, args.failover == 'fail')
+    if args.count and getattr(graph, 'rules', None) is not None:
+        print >> sys.stderr, "%d rules" % (graph.rules)
+    profile.report(sys.stderr, args.profile)
@@ -0,0 +1,229 @@
+#!/usr/bin/python
+
+'''This file measures how the topology generators scale. Every run is a
+separate invocation of abfattree.py, fattree.py or graph2digraph.py, for
+which the wall time, peak RSS and the lines and bytes of its output (the
+KAT file of abfattree.py, the DOT file of the others) are recorded, and for
+abfattree.py the number of rules it reports with --count. Results are
+written as JSON and can be compared against a stored baseline, on time,
+memory and the rule count:
+
+  benchmark.py -F 4 8 -D 3 --save-baseline base.json
+  benchmark.py -F 4 8 -D 3 -b base.json --threshold 0.2
+'''
+
+import re
+import sys
+import os
+import glob
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+# the line of abfattree.py --count
+RULES = re.compile(r'^(\d+) rules$', re.M)
+EXAMPLES = os.path.join(os.path.dirname(SCRIPTS), 'examples')
+
+def abfattree_cases(fanouts, depths, kattypes, failovers, localities):
+    for fanout in fanouts:
+        for depth in depths:
+            for kattype in kattypes:
+                for failover in failovers:
+                    for local in localities:
+                        yield {'name': "abfattree %d %d %s %s %s" % (fanout, depth, kattype, failover, local),
+                               'script': 'abfattree.py',
+                               'args': [str(fanout), str(depth), '-t', kattype, '-f', failover, '-l', local,
+                                        '-o', '{dot}', '-k', '{kat}', '--count']}
+
+def fattree_cases(fanouts, depths):
+    for fanout in fanouts:
+        for depth in depths:
+            yield {'name': "fattree %d %d" % (fanout, depth),
+                   'script': 'fattree.py',
+                   'args': [str(fanout), str(depth), '-o', '{dot}']}
+
+def graph2digraph_cases(inputs):
+    for path in inputs:
+        yield {'name': "graph2digraph %s" % (os.path.basename(path)),
+               'script': 'graph2digraph.py',
+               'args': ['-i', path, '-o', '{dot}']}
+
+def count_lines(path):
+    '''number of lines of path'''
+    if not os.path.exists(path):
+        return 0
+    n = 0
+    with open(path) as f:
+        for line in f:
+            n += 1
+    return n
+
+def run_case(case, python, timeout):
+    '''runs one case in a child process and returns its measurements. wait4
+    gives the resource usage of that child alone, so peak RSS is not mixed
+    up between runs.'''
+    tmpdir = tempfile.mkdtemp(prefix='benchmark')
+    outputs = {'dot': os.path.join(tmpdir, 'out.dot'),
+               'kat': os.path.join(tmpdir, 'out.kat')}
+    args = [a.format(**outputs) for a in case['args']]
+    cmd = [python, os.path.join(SCRIPTS, case['script'])] + args
+    result = {'name': case['name'], 'command': cmd}
+    try:
+        errpath = os.path.join(tmpdir, 'stderr')
+        with open(os.devnull, 'w') as devnull, open(errpath, 'w') as errfile:
+            start = time.time()
+            proc = subprocess.Popen(cmd, stdout=devnull, stderr=errfile)
+            while True:
+                pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+                if pid:
+                    break
+                if timeout and time.time() - start > timeout:
+                    proc.kill()
+                    pid, status, rusage = os.wait4(proc.pid, 0)
+                    result['status'] = 'timeout'
+                    break
+                time.sleep(0.01)
+            wall = time.time() - start
+        with open(errpath) as f:
+            err = f.read()
+        result['wall'] = wall
+        result['cpu'] = rusage.ru_utime + rusage.ru_stime
+        result['maxrss_kb'] = rusage.ru_maxrss
+        if 'status' not in result:
+            if status == 0:
+                result['status'] = 'ok'
+            else:
+                result['status'] = 'error'
+                result['error'] = err.strip().split('\n')[-1]
+        m = RULES.search(err)
+        result['rules'] = int(m.group(1)) if m else None
+        path = outputs['kat'] if case['script'] == 'abfattree.py' else outputs['dot']
+        result['lines'] = count_lines(path)
+        result['bytes'] = os.path.getsize(path) if os.path.exists(path) else 0
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return result
+
+def compare(results, baseline, threshold, min_time):
+    '''returns the names of the cases that got slower or bigger than the
+    baseline by more than threshold (a fraction); runs faster than min_time
+    seconds are too noisy to compare on time. A case whose rule count
+    changed is flagged; its lines and bytes are only listed.'''
+    base = dict((r['name'], r) for r in baseline['results'])
+    regressions = []
+    print "%-48s %10s %10s %8s %10s %10s %8s %10s %10s" % \
+        ('case', 'wall', 'base', 'ratio', 'rss_kb', 'base', 'ratio', 'lines', 'base')
+    for r in results:
+        b = base.get(r['name'])
+        if b is None or r['status'] != 'ok' or b['status'] != 'ok':
+            continue
+        tratio = r['wall'] / b['wall'] if b['wall'] else 1.0
+        mratio = float(r['maxrss_kb']) / b['maxrss_kb'] if b['maxrss_kb'] else 1.0
+        flags = []
+        if tratio > 1 + threshold and max(r['wall'], b['wall']) >= min_time:
+            flags.append('SLOWER')
+        if mratio > 1 + threshold:
+            flags.append('BIGGER')
+        if r.get('rules') is not None and b.get('rules') is not None and r['rules'] != b['rules']:
+            flags.append('RULES CHANGED')
+        print "%-48s %10.3f %10.3f %8.2f %10d %10d %8.2f %10d %10d %s" % \
+            (r['name'], r['wall'], b['wall'], tratio, r['maxrss_kb'], b['maxrss_kb'], mratio,
+             r['lines'], b.get('lines', 0), " ".join(flags))
+        if 'SLOWER' in flags or 'BIGGER' in flags:
+            regressions.append(r['name'])
+    return regressions
+
+def parse_args():
+    from abfattree import KATTYPES
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-F", "--fanouts", dest='fanouts', nargs='+', type=int,
+                        default=[4, 8],
+                        help='fanouts to sweep')
+    parser.add_argument("-D", "--depths", dest='depths', nargs='+', type=int,
+                        default=[3],
+                        help='depths to sweep')
+    parser.add_argument("-t", "--types", dest='kattypes', nargs='+',
+                        choices=KATTYPES, default=KATTYPES,
+                        help='KAT policy types of abfattree.py to sweep')
+    parser.add_argument("--ft", dest='failovers', nargs='+',
+                        choices=['nofail', 'fail'], default=['nofail', 'fail'],
+                        help='failover settings to sweep')
+    parser.add_argument("--local", dest='localities', nargs='+',
+                        choices=['full', 'local'], default=['full', 'local'],
+                        help='local settings to sweep')
+    parser.add_argument("-i", "--inputs", dest='inputs', nargs='*',
+                        default=sorted(glob.glob(os.path.join(EXAMPLES, '*.dot')) +
+                                       glob.glob(os.path.join(EXAMPLES, '*.gml'))),
+                        help='inputs of graph2digraph.py')
+    parser.add_argument("-s", "--scripts", dest='scripts', nargs='+',
+                        choices=['abfattree', 'fattree', 'graph2digraph'],
+                        default=['abfattree', 'fattree', 'graph2digraph'],
+                        help='scripts to benchmark')
+    parser.add_argument("-p", "--python", dest='python', action='store',
+                        default=sys.executable,
+                        help='interpreter to run the scripts with')
+    parser.add_argument("--timeout", dest='timeout', action='store', type=float,
+                        default=None,
+                        help='seconds after which a run is killed')
+    parser.add_argument("-o", "--out", dest='output', action='store',
+                        default=None,
+                        help='file to write the JSON results to')
+    parser.add_argument("-b", "--baseline", dest='baseline', action='store',
+                        default=None,
+                        help='JSON results to compare against')
+    parser.add_argument("--save-baseline", dest='save_baseline', action='store',
+                        default=None,
+                        help='also write the results to this baseline file')
+    parser.add_argument("--threshold", dest='threshold', action='store', type=float,
+                        default=0.2,
+                        help='relative slowdown or growth that counts as a regression')
+    parser.add_argument("--min-time", dest='min_time', action='store', type=float,
+                        default=0.1,
+                        help='runs shorter than this many seconds are not compared on time')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    cases = []
+    if 'abfattree' in args.scripts:
+        cases.extend(abfattree_cases(args.fanouts, args.depths, args.kattypes, args.failovers, args.localities))
+    if 'fattree' in args.scripts:
+        cases.extend(fattree_cases(args.fanouts, args.depths))
+    if 'graph2digraph' in args.scripts:
+        cases.extend(graph2digraph_cases(args.inputs))
+
+    results = []
+    for case in cases:
+        r = run_case(case, args.python, args.timeout)
+        rules = "%8d rules" % (r['rules']) if r.get('rules') is not None else " " * 14
+        print >> sys.stderr, "%-48s %-8s %8.3fs %8dKB %s %8d lines %10d bytes" % \
+            (r['name'], r['status'], r['wall'], r['maxrss_kb'], rules, r['lines'], r['bytes'])
+        results.append(r)
+
+    report = {'host': socket.gethostname(),
+              'platform': platform.platform(),
+              'python': args.python,
+              'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'results': results}
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=1, sort_keys=True)
+    if not args.output and not args.save_baseline:
+        print json.dumps(report, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold, args.min_time)
+        if regressions:
+            print "%d regression(s) over %d%%" % (len(regressions), args.threshold * 100)
+            exit(1)
@@ -0,0 +1,66 @@
+'''Streaming DOT output for the topology scripts.
+
+Nodes are written before the edges, one statement per line, in the form
+the DOT reader of lib/Parsers.ml accepts: every node has an attribute list,
+id, sport, dport, cost and ports (the members of an aggregated link) are
+bare numbers, and ip, mac and capacity are quoted strings. That reader
+fails on any other attribute, so other attributes are dropped.'''
+
+import re
+import string
+
+NODE_ATTRS = ['type', 'id', 'ip', 'mac']
+EDGE_ATTRS = ['sport', 'dport', 'capacity', 'cost', 'ports']
+NUMERIC = set(['id', 'sport', 'dport', 'cost', 'ports'])
+
+IDENT = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+def unquote(s):
+    '''strips the quotes pydot keeps around the values it reads'''
+    if len(s) > 1 and s[0] == '"' and s[-1] == '"':
+        return s[1:-1]
+    return s
+
+def quote(s):
+    return '"%s"' % (s.replace('"', '\\"'))
+
+def dot_id(name):
+    name = unquote(str(name))
+    if IDENT.match(name):
+        return name
+    return quote(name)
+
+def dot_value(key, v):
+    s = unquote(str(v))
+    if key in NUMERIC or (key == 'type' and IDENT.match(s)):
+        return s
+    return quote(s)
+
+def attr_list(keys, attrs):
+    return string.join(["%s=%s" % (k, dot_value(k, attrs[k])) for k in keys if k in attrs], ", ")
+
+def dot_lines(name, nodes, edges):
+    '''yields the lines of a digraph; nodes yields (name, attrs) and edges
+    (src, dst, attrs)'''
+    if name:
+        yield "digraph %s {\n" % (dot_id(name))
+    else:
+        yield "digraph {\n"
+    for node, attrs in nodes:
+        yield "%s [%s];\n" % (dot_id(node), attr_list(NODE_ATTRS, attrs))
+    for src, dst, attrs in edges:
+        yield "%s -> %s [%s];\n" % (dot_id(src), dot_id(dst), attr_list(EDGE_ATTRS, attrs))
+    yield "}\n"
+
+def write_dot(f, name, nodes, edges, bufsize=1 << 20):
+    '''writes the digraph to f, in writes of about bufsize bytes'''
+    buf = []
+    size = 0
+    for line in dot_lines(name, nodes, edges):
+        buf.append(line)
+        size += len(line)
+        if size >= bufsize:
+            f.write(string.join(buf, ""))
+            buf = []
+            size = 0
+    f.write(string.join(buf, ""))
@@ -3,59 +3,236 @@
 '''this file generates a simple fat tree in dot notation with few assumptions:
 1) the root is always 1 node
 2) all switches have same incoming and outgoing edges, except the root node
-3) all switches have same fan out '''
+3) all switches have same fan out
 
+A child and its parent are linked by as many parallel links as the child
+has hosts below it. With --aggregate, each bundle is written as one link
+whose ports attribute is the number of members: they use the ports sport..
+and dport.. on, and capacity is their sum. --expand writes the members of
+the aggregated links of a DOT file back as single links.'''
+
+import re
 import sys
 import argparse
-import networkx as nx
-
-def generate(fanout,depth):
-    switches = ['s'+ str(i) for i in range(1, ((1 - (fanout ** depth)) / (1 - fanout))+1)]
-    hosts = ['h' + str(i) for i in range(1, fanout ** depth + 1)]
-    nodes = switches + hosts
-    g = nx.MultiDiGraph()
-    g.add_nodes_from(nodes)
-
-    for i in range(depth,0,-1):
-        '''length of temp1 = (length of temp2) * fanout'''
-        temp1 = nodes[len(nodes) - (fanout ** i):]
-        nodes = nodes[:len(nodes) - (fanout ** i)]
-        temp2 = nodes[len(nodes) - (fanout ** (i-1)):]
-        for j in range(len(temp2)):
+import itertools
+from array import array
+import profiling
+import dotwriter
+import streamreader
+from abfattree import mac_strings, ip_strings
+
+class FatTree(object):
+    '''fat tree with integer node ids: switches s1..sS are 0..S-1, level by
+    level from the root, and hosts h1..hH are S..S+H-1. Links are kept as
+    columns of src, dst, sport and dport; every link has the same capacity
+    and cost.'''
+
+    capacity = '1Gbps'
+    cost = '1'
+
+    def __init__(self, fanout, depth, aggregate=False):
+        self.fanout = fanout
+        self.depth = depth
+        self.nswitches = sum([fanout ** i for i in range(depth)])
+        self.nhosts = fanout ** depth
+        self.switches = xrange(self.nswitches)
+        self.hosts = xrange(self.nswitches, self.nswitches + self.nhosts)
+        self.src = array('i')
+        self.dst = array('i')
+        self.sport = array('i')
+        self.dport = array('i')
+        # members of each link if parallel links are aggregated
+        self.ports = array('i') if aggregate else None
+
+    def first(self, level):
+        '''id of the first node of level, where the root is level 0 and the
+        hosts are level depth'''
+        return sum([self.fanout ** i for i in range(level)])
+
+    def edges(self):
+        '''yields (src, dst, sport, dport) for every link'''
+        return itertools.izip(self.src, self.dst, self.sport, self.dport)
+
+    def is_host(self, node):
+        return node >= self.nswitches
+
+    def id(self, node):
+        if node >= self.nswitches:
+            return node - self.nswitches + 1
+        return node + 1
+
+    def name(self, node):
+        if node >= self.nswitches:
+            return 'h' + str(node - self.nswitches + 1)
+        return 's' + str(node + 1)
+
+    def dot_nodes(self):
+        '''yields (name, attrs) for every node'''
+        for node in self.switches:
+            yield self.name(node), {'type': 'switch', 'id': self.id(node)}
+        macs = mac_strings(1, self.nhosts)
+        ips = ip_strings(1, self.nhosts)
+        for i in xrange(self.nhosts):
+            yield 'h' + str(i + 1), {'type': 'host', 'id': i + 1, 'mac': macs[i], 'ip': ips[i]}
+
+    def dot_edges(self):
+        '''yields (src, dst, attrs) for every link'''
+        if self.ports is not None:
+            return self.aggregated_dot_edges()
+        return ((self.name(src), self.name(dst),
+                 {'sport': sport, 'dport': dport, 'capacity': self.capacity, 'cost': self.cost})
+                for src, dst, sport, dport in self.edges())
+
+    def aggregated_dot_edges(self):
+        member = capacity_bps(self.capacity)
+        for (src, dst, sport, dport), n in itertools.izip(self.edges(), self.ports):
+            attrs = {'sport': sport, 'dport': dport, 'capacity': self.capacity, 'cost': self.cost}
+            if n > 1:
+                attrs['capacity'] = capacity_string(n * member)
+                attrs['ports'] = n
+            yield self.name(src), self.name(dst), attrs
+
+    def write_dot(self, f):
+        dotwriter.write_dot(f, 'fattree', self.dot_nodes(), self.dot_edges())
+
+def generate(fanout, depth, aggregate=False):
+    '''child k of node j of level i-1 is node fanout*j + k of level i. A node
+    of level i < depth has p = fanout**(depth-i) hosts below it, and p links
+    to its parent, on its up ports p+1..2p; they arrive on the parent's down
+    ports fanout*k+1..fanout*k+p. A host is linked once, from its port 1.
+    With aggregate, the p links are kept as one link and its reverse, on
+    the first port of each range.'''
+    g = FatTree(fanout, depth, aggregate)
+    src = g.src
+    dst = g.dst
+    sport = g.sport
+    dport = g.dport
+    for i in range(depth, 0, -1):
+        children = g.first(i)
+        parents = g.first(i - 1)
+        p = fanout ** (depth - i)
+        # every link is added as child -> parent, then parent -> child
+        for j in xrange(fanout ** (i - 1)):
+            parent = parents + j
             for k in range(fanout):
-                p = fanout ** (depth - i)
+                child = children + fanout * j + k
                 if p == 1:
-                    g.add_edge(temp1[fanout * j + k],temp2[j],
-                               attr_dict={'sport':1,'dport':k+1,'capacity':'1Gbps','cost':'1'})
-                    g.add_edge(temp2[j],temp1[fanout * j + k],
-                               attr_dict={'sport':k+1,'dport':1,'capacity':'1Gbps','cost':'1'})
-                else:
-                    for l in range(p):
-                        g.add_edge(temp1[fanout * j + k],temp2[j],
-                                   attr_dict={'sport':p+l+1,'dport': fanout * k + l+1,'capacity':'1Gbps','cost':'1'})
-                        g.add_edge(temp2[j],temp1[fanout * j + k],
-                                   attr_dict={'sport':fanout * k + l+1,'dport': p+l+1,'capacity':'1Gbps','cost':'1'})
-
+                    src.extend((child, parent))
+                    dst.extend((parent, child))
+                    sport.extend((1, k + 1))
+                    dport.extend((k + 1, 1))
+                    if aggregate:
+                        g.ports.extend((1, 1))
+                    continue
+                if aggregate:
+                    src.extend((child, parent))
+                    dst.extend((parent, child))
+                    sport.extend((p + 1, fanout * k + 1))
+                    dport.extend((fanout * k + 1, p + 1))
+                    g.ports.extend((p, p))
+                    continue
+                ups = array('i', range(p + 1, 2*p + 1))
+                downs = array('i', range(fanout * k + 1, fanout * k + p + 1))
+                pair = array('i', [0]) * (2*p)
+                src.extend(array('i', [child, parent]) * p)
+                dst.extend(array('i', [parent, child]) * p)
+                pair[0::2] = ups
+                pair[1::2] = downs
+                sport.extend(pair)
+                pair[0::2] = downs
+                pair[1::2] = ups
+                dport.extend(pair)
     return g
 
+RATE = re.compile(r'^([0-9]+)([kMGT]?)bps$')
+UNITS = {'': 1, 'k': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9, 'T': 10 ** 12}
+
+def capacity_bps(capacity):
+    m = RATE.match(dotwriter.unquote(str(capacity)))
+    if m is None:
+        raise ValueError("cannot split the capacity %r" % (capacity))
+    return int(m.group(1)) * UNITS[m.group(2)]
+
+def capacity_string(bps):
+    return streamreader.gml_capacity({'LinkSpeedRaw': bps})
+
+def expand_links(edges):
+    '''yields the member links of the aggregated links of edges, (src, dst,
+    attrs) as read from DOT, and the other links as they are'''
+    for src, dst, attrs in edges:
+        n = int(attrs.get('ports', 1))
+        if n == 1:
+            attrs.pop('ports', None)
+            yield src, dst, attrs
+            continue
+        sport = int(attrs['sport'])
+        dport = int(attrs['dport'])
+        total = capacity_bps(attrs['capacity'])
+        if total % n:
+            raise ValueError("%s -> %s: %s is not %d equal links" % (src, dst, attrs['capacity'], n))
+        member = dict(attrs)
+        del member['ports']
+        member['capacity'] = capacity_string(total / n)
+        for l in range(n):
+            m = dict(member)
+            m['sport'] = sport + l
+            m['dport'] = dport + l
+            yield src, dst, m
+
+def expand_file(input, f):
+    '''writes the DOT file input to f with its aggregated links expanded'''
+    topo = streamreader.Topology(input)
+    dotwriter.write_dot(f, topo.name, topo.nodes.iteritems(), expand_links(topo.edges()))
+
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument("fanout", type=int,
+    parser.add_argument("fanout", type=int, nargs='?',
                         help="number of children each node should have")
-    parser.add_argument("depth", type=int,
+    parser.add_argument("depth", type=int, nargs='?',
                         help="depth of the fattree")
+    parser.add_argument("-a", "--aggregate", dest='aggregate', action='store_true',
+                        help='write the parallel links between two switches as one link')
+    parser.add_argument("-x", "--expand", dest='expand', action='store',
+                        default=None,
+                        help='instead of generating a tree, expand the aggregated links of this DOT file')
     parser.add_argument("-o", "--out", dest='output', action='store',
                         default=None,
                         help='file to write to')
+    parser.add_argument("--profile", dest='profile', action='store',
+                        nargs='?', const='table', default=None,
+                        choices=['table', 'json'],
+                        help='print per-phase timings to stderr')
+    parser.add_argument("--pstats", dest='pstats', action='store',
+                        default=None,
+                        help='run under cProfile and dump the stats to this file')
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.expand is None and args.depth is None:
+        parser.error("fanout and depth are required")
+    return args
 
 
 if __name__ == "__main__":
     args = parse_args()
-    graph = generate(args.fanout, args.depth)
+    profile = profiling.Profile(args.profile is not None, args.pstats)
+    profile.start()
+    if args.expand:
+        with profile.phase('expand'):
+            if args.output:
+                with open(args.output, 'w') as f:
+                    expand_file(args.expand, f)
+            else:
+                expand_file(args.expand, sys.stdout)
+        profile.report(sys.stderr, args.profile)
+        exit(0)
+
+    with profile.phase('generate'):
+        graph = generate(args.fanout, args.depth, args.aggregate)
 
-    if args.output:
-        nx.write_dot(graph,args.output)
-    else:
-        print nx.to_agraph(graph)
+    with profile.phase('dot'):
+        if args.output:
+            with open(args.output, 'w') as f:
+                graph.write_dot(f)
+        else:
+            graph.write_dot(sys.stdout)
+    profile.report(sys.stderr, args.profile)
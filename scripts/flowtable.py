@@ -0,0 +1,121 @@
+'''Binary flow tables, for controllers that load the switch tables without
+parsing NetKAT.
+
+A file is a 32 byte header, an index and fixed-width records, all little
+endian:
+
+  header  magic 'ABFT', version, record size, number of switches n,
+          number of records (uint32 x4, uint64, then 8 reserved bytes)
+  index   n+1 uint64: the records of switch id s are index[s-1] .. index[s]-1
+  records switch (uint32), inport, outport, backup, flags (uint16 x4),
+          4 padding bytes, dst_lo, dst_hi (uint64 x2)
+
+A record matches a packet at switch that came in on inport (0 for any
+port) and whose ethDst, as an integer, is in dst_lo .. dst_hi, or is not
+in it if flags has NEGATE. The packet is sent out of outport or, if the
+link of outport is down and backup is not 0, out of backup: a record is a
+fast-failover group. The NetKAT policy writes the two ports as a union,
+which the controller loads as such a group. Like the union of the NetKAT
+policy, a packet is sent by every record that matches it.
+
+Records are aligned, so FlowTables can map the file and, with NumPy, view
+the records as a structured array without copying them.'''
+
+import sys
+import mmap
+import struct
+
+MAGIC = 'ABFT'
+VERSION = 1
+NEGATE = 1
+
+HEADER = struct.Struct('<4sIIIQQ')
+RECORD = struct.Struct('<IHHHHIQQ')
+
+# the same layout as RECORD, as a NumPy dtype
+FIELDS = [('switch', '<u4'), ('inport', '<u2'), ('outport', '<u2'), ('backup', '<u2'),
+          ('flags', '<u2'), ('pad', '<u4'), ('dst_lo', '<u8'), ('dst_hi', '<u8')]
+
+def write_tables(f, nswitches, rules):
+    '''writes the tables of switch ids 1..nswitches to f. rules yields
+    (switch, inport, negate, dst_lo, dst_hi, outports) in any order; the
+    records of a switch keep their order.'''
+    tables = [bytearray() for s in range(nswitches + 1)]
+    pack = RECORD.pack
+    for switch, inport, negate, lo, hi, outports in rules:
+        if len(outports) == 1:
+            outport, backup = outports[0], 0
+        elif len(outports) == 2:
+            outport, backup = outports
+        else:
+            raise ValueError("a record has at most 2 out ports, got %r" % (outports,))
+        tables[switch] += pack(switch, inport, outport, backup, NEGATE if negate else 0, 0, lo, hi)
+    index = [0]
+    for s in range(1, nswitches + 1):
+        index.append(index[-1] + len(tables[s]) / RECORD.size)
+    f.write(HEADER.pack(MAGIC, VERSION, RECORD.size, nswitches, index[-1], 0))
+    f.write(struct.pack('<%dQ' % (len(index)), *index))
+    for s in range(1, nswitches + 1):
+        f.write(tables[s])
+
+class FlowTables(object):
+    '''the tables of a file written by write_tables, mapped read-only.
+    records is a NumPy structured array over the mapping if NumPy is
+    available, and a list of RECORD tuples otherwise.'''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, size, self.nswitches, self.count, reserved = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION or size != RECORD.size:
+            raise ValueError("%s is not a version %d flow table file" % (path, VERSION))
+        offset = HEADER.size + 8 * (self.nswitches + 1)
+        if len(self.map) != offset + self.count * RECORD.size:
+            raise ValueError("%s is truncated" % (path))
+        self.index = struct.unpack_from('<%dQ' % (self.nswitches + 1), self.map, HEADER.size)
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        if numpy is not None:
+            self.records = numpy.frombuffer(self.map, numpy.dtype(FIELDS), self.count, offset)
+        else:
+            self.records = [RECORD.unpack_from(self.map, offset + i * RECORD.size)
+                            for i in range(self.count)]
+
+    def __len__(self):
+        return self.count
+
+    def table(self, switch):
+        '''the records of switch id switch'''
+        return self.records[self.index[switch - 1]:self.index[switch]]
+
+    def lookup(self, switch, inport, dst, down=()):
+        '''the sorted out ports of a packet from inport to the integer MAC dst
+        at switch, when the links of the ports in down are down'''
+        ports = set()
+        for r in self.table(switch):
+            s, rin, outport, backup, flags, pad, lo, hi = r
+            if rin and rin != inport:
+                continue
+            if (lo <= dst <= hi) == bool(flags & NEGATE):
+                continue
+            if outport in down:
+                outport = backup
+            if outport and outport not in down:
+                ports.add(int(outport))
+        return sorted(ports)
+
+    def close(self):
+        self.records = None
+        self.map.close()
+
+
+if __name__ == "__main__":
+    # prints the records of a file, or of the switches given after it
+    tables = FlowTables(sys.argv[1])
+    switches = map(int, sys.argv[2:]) or range(1, tables.nswitches + 1)
+    for s in switches:
+        for r in tables.table(s):
+            s, inport, outport, backup, flags, pad, lo, hi = r
+            print "%d %d %s%d-%d %d %d" % (s, inport, '!' if flags & NEGATE else '', lo, hi, outport, backup)
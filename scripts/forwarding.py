@@ -0,0 +1,154 @@
+'''Forwarding of many packets at once through the switch tables of an AB
+fat tree, as NumPy arrays.
+
+The tables are rules (switch, inport, negate, dst_lo, dst_hi, outports) as
+yielded by abfattree.flow_rules, or as stored in the files of flowtable.py,
+with switches and hosts numbered by id. Every packet is a flow index into
+the batch it came in; forward() moves all of them one hop at a time and
+reports what happens to each, so callers can add up loads or check every
+(src, dst) pair.'''
+
+import numpy as np
+
+class Classifier(object):
+    '''the rules of the tables of graph as arrays, with the switch, in-port
+    and destination host as 0-based indices. A rule matches on (switch,
+    in-port, host), on (switch, host) from any port, or on (switch, in-port)
+    for the hosts outside a range; outports has the port and the backup
+    port, 0 if there is none.'''
+
+    def __init__(self, graph, rules):
+        H = graph.nhosts
+        S = graph.nswitches
+        self.stride = stride = 2*graph.p + 1
+        self.H = H
+        keys = []
+        outs = []
+        self.any_out = np.zeros((S * H, 2), np.int32)
+        self.range_lo = np.zeros(S * stride, np.int64)
+        self.range_hi = np.full(S * stride, -1, np.int64)
+        self.range_out = np.zeros((S * stride, 2), np.int32)
+        for switch, inport, negate, lo, hi, outports in rules:
+            node = switch - 1
+            ports = (tuple(outports) + (0,))[:2]
+            if negate:
+                r = node*stride + inport
+                self.range_lo[r] = lo - 1
+                self.range_hi[r] = hi - 1
+                self.range_out[r] = ports
+            elif inport:
+                for dst in range(lo - 1, hi):
+                    keys.append((node*stride + inport)*H + dst)
+                    outs.append(ports)
+            else:
+                self.any_out[node*H + lo - 1:node*H + hi] = ports
+        self.range_has = self.range_out[:, 0] > 0
+        keys = np.array(keys, np.int64)
+        order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[order]
+        self.outs = np.array(outs, np.int32).reshape(-1, 2)[order]
+        # the links, as in graph.peer and graph.peer_port
+        self.peer = np.frombuffer(graph.peer, np.int32).astype(np.int64)
+        self.peer_port = np.frombuffer(graph.peer_port, np.int32).astype(np.int64)
+
+    def matches(self, node, inport, dst):
+        '''yields (selected flows, their outports) for every kind of rule that
+        matches some of the flows'''
+        key = (node*self.stride + inport)*self.H + dst
+        if len(self.keys):
+            idx = np.minimum(np.searchsorted(self.keys, key), len(self.keys) - 1)
+            hit = self.keys[idx] == key
+            if hit.any():
+                yield hit, self.outs[idx[hit]]
+        out = self.any_out[node*self.H + dst]
+        hit = out[:, 0] > 0
+        if hit.any():
+            yield hit, out[hit]
+        r = node*self.stride + inport
+        hit = self.range_has[r] & ((dst < self.range_lo[r]) | (dst > self.range_hi[r]))
+        if hit.any():
+            yield hit, self.range_out[r[hit]]
+
+def failed_ports(graph, links):
+    '''a mask of the ports node*stride + port whose link is down'''
+    stride = 2*graph.p + 1
+    dead = np.zeros((graph.nswitches + graph.nhosts) * stride, bool)
+    peer = np.frombuffer(graph.peer, np.int32)
+    for a, b in links:
+        ports = [port for port in range(1, stride) if peer[a*stride + port] == b]
+        if not ports:
+            raise ValueError("no link between %s and %s" % (graph.name(a), graph.name(b)))
+        for port in ports:
+            dead[a*stride + port] = True
+            dead[b*stride + graph.peer_port[a*stride + port]] = True
+    return dead
+
+def forward(graph, classifier, dead, src, dst, hops=None):
+    '''sends one packet from every host index src[i] to dst[i] and yields
+    the events of the packets as (kind, flows, copies, ...) with flows the
+    indices i and copies how many packets of the flow it stands for:
+    ('link', flows, copies, links) for the ports node*stride + port they
+    leave by, ('delivered', flows, copies) and ('wrong', flows, copies,
+    hosts) when they reach a host, ('dropped', flows, copies, nodes) when
+    they are not sent on, and ('looping', flows, copies) for the ones still
+    in the network after hops switches. A packet is sent by every rule that
+    matches it, as in the union of the NetKAT policy. A failover rule is a
+    fast-failover group, as in FlowTables.lookup: it sends out of its backup
+    port only when the link of its port is down, and drops the packet when
+    both are. The copies of a flow on the same link are forwarded as one.'''
+    stride = classifier.stride
+    S = graph.nswitches
+    peer = classifier.peer
+    peer_port = classifier.peer_port
+    if hops is None:
+        hops = 4 * (graph.L + 1) + 4
+    flow = np.arange(len(src))
+    copies = np.ones(len(src), np.int64)
+    # the first hop is the host link
+    link = (np.asarray(src, np.int64) + S)*stride + 1
+    dst = np.asarray(dst, np.int64)
+    up = ~dead[link]
+    if not up.all():
+        yield 'dropped', flow[~up], copies[~up], np.asarray(src)[~up] + S
+    flow, copies, link, dst = flow[up], copies[up], link[up], dst[up]
+    yield 'link', flow, copies, link
+    node, inport = peer[link], peer_port[link]
+    for hop in range(hops):
+        if not len(node):
+            return
+        flows, counts, nodes, dsts, ports = [], [], [], [], []
+        matched = np.zeros(len(node), bool)
+        for hit, outports in classifier.matches(node, inport, dst):
+            matched |= hit
+            base = node[hit]*stride
+            port = np.where(dead[base + outports[:, 0]], outports[:, 1], outports[:, 0])
+            sent = (port > 0) & ~dead[base + port]
+            flows.append(flow[hit][sent])
+            counts.append(copies[hit][sent])
+            nodes.append(node[hit][sent])
+            ports.append(port[sent])
+            dsts.append(dst[hit][sent])
+            if not sent.all():
+                yield 'dropped', flow[hit][~sent], copies[hit][~sent], node[hit][~sent]
+        if not matched.all():
+            yield 'dropped', flow[~matched], copies[~matched], node[~matched]
+        if not flows:
+            return
+        flow = np.concatenate(flows)
+        link = np.concatenate(nodes)*stride + np.concatenate(ports)
+        dst = np.concatenate(dsts)
+        # merge the copies of a flow that leave by the same link
+        keys, first, merged = np.unique(flow*len(dead) + link, return_index=True, return_inverse=True)
+        copies = np.bincount(merged, np.concatenate(counts)).astype(np.int64)
+        flow, link, dst = flow[first], link[first], dst[first]
+        yield 'link', flow, copies, link
+        node, inport = peer[link], peer_port[link]
+        host = node >= S
+        right = host & (node - S == dst)
+        yield 'delivered', flow[right], copies[right]
+        wrong = host & ~right
+        if wrong.any():
+            yield 'wrong', flow[wrong], copies[wrong], node[wrong]
+        flow, copies, node, inport, dst = flow[~host], copies[~host], node[~host], inport[~host], dst[~host]
+    if len(flow):
+        yield 'looping', flow, copies
@@ -4,57 +4,254 @@
 that is a DOT digraph. This is mainly because ocaml-topology is currently backed
 by an ocamlgraph DirectedGraph, but the ocamlgraph DOT parser does not
 create a pair of symmetric directed links for each undirected DOT link.
+GML files (e.g. from the Topology Zoo) are read as well, and with -d many
+files are converted at once by a pool of -j workers. The input is read
+twice, once for the nodes and once for the edges, which are written out
+with their reverse as they are read, so only the nodes are kept in memory.
+The edges of a digraph or a strict graph may already be there in both
+directions or be repeated, so for these the endpoints and ports of the
+edges written are kept as well, to write each once.
 '''
 
 import sys
+import os
+import glob
+import json
+import time
+import hashlib
 import argparse
-import networkx as nx
+import itertools
+import profiling
+import dotwriter
+import streamreader
 
-def convert(graph):
-    digraph = nx.DiGraph()
-    for (src,dst,attrs) in graph.edges_iter(data=True):
-        digraph.add_edge(src,dst,attrs)
+# content hashes of the inputs of a batch, kept in its output directory
+MANIFEST = '.graph2digraph.json'
 
-        # Add the symmetric, reversed edge
-        revattrs = { 'sport' : attrs['dport'], 'dport' : attrs['dport'],
-                     'capacity' : attrs['capacity'], 'cost' : attrs['cost']
-                     }
-        digraph.add_edge(dst,src,revattrs)
+def reverse(attrs):
+    '''attributes of the symmetric, reversed edge'''
+    revattrs = dict(attrs)
+    if 'dport' in attrs:
+        revattrs['sport'] = attrs['dport']
+    if 'sport' in attrs:
+        revattrs['dport'] = attrs['sport']
+    return revattrs
 
-    # Need to add in nodes explicitly, because there might be unconnected nodes
-    # in the original
-    for node,attrs in graph.nodes_iter(data=True):
-        digraph.add_node(node,attrs)
+def symmetric(edges, kind='graph'):
+    '''yields every edge followed by its reverse, but for a self-loop with
+    equal ports, which is its own reverse. The edges of a graph of any
+    other kind (a digraph that has both directions already, or a strict
+    graph that repeats an edge) are yielded once each by (src, dst, sport,
+    dport); a plain graph is streamed as it is.'''
+    unique = kind != 'graph'
+    seen = set()
+    for src, dst, attrs in edges:
+        pair = [(src, dst, attrs)]
+        if src != dst or attrs.get('sport') != attrs.get('dport'):
+            pair.append((dst, src, reverse(attrs)))
+        for edge in pair:
+            if unique:
+                key = (edge[0], edge[1], edge[2].get('sport'), edge[2].get('dport'))
+                if key in seen:
+                    continue
+                seen.add(key)
+            yield edge
 
-    digraph.graph['name'] = graph.graph['name']
-    return digraph
+def convert_file(input, output):
+    '''converts input to output through a temporary file, so a failed run
+    leaves no partial output, and returns (nodes, edges) written'''
+    topo = streamreader.Topology(input)
+    counter = itertools.count()
+    edges = ((src, dst, attrs) for (src, dst, attrs), _ in
+             itertools.izip(symmetric(topo.edges(), topo.kind), counter))
+    tmp = output + '.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            dotwriter.write_dot(f, topo.name, topo.nodes.iteritems(), edges)
+        os.rename(tmp, output)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return len(topo.nodes), next(counter)
+
+def expand_inputs(patterns):
+    '''input files of patterns, which may be files, globs or directories'''
+    inputs = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            paths = glob.glob(os.path.join(pattern, '*.dot')) + glob.glob(os.path.join(pattern, '*.gml'))
+        else:
+            paths = glob.glob(pattern) or [pattern]
+        for path in sorted(paths):
+            if path not in inputs:
+                inputs.append(path)
+    return inputs
+
+def output_of(input, outdir):
+    return os.path.join(outdir, os.path.splitext(os.path.basename(input))[0] + '.dot')
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def up_to_date(input, output, hashes):
+    '''an output is up to date if it is newer than its input, or if the
+    input has the same content hash as when the output was written'''
+    if not os.path.exists(output):
+        return False
+    if os.path.getmtime(output) >= os.path.getmtime(input):
+        return True
+    if hashes.get(os.path.abspath(input)) == file_hash(input):
+        # only touched; the next run can go by mtime again
+        os.utime(output, None)
+        return True
+    return False
+
+def convert_task(args):
+    '''converts one file of a batch; errors are returned, not raised, so a
+    bad file does not stop the others'''
+    input, output = args
+    start = time.time()
+    try:
+        nodes, edges = convert_file(input, output)
+        return {'input': input, 'output': output, 'status': 'ok',
+                'nodes': nodes, 'edges': edges, 'bytes': os.path.getsize(input),
+                'hash': file_hash(input), 'time': time.time() - start}
+    except Exception as e:
+        return {'input': input, 'output': output, 'status': 'failed',
+                'error': "%s: %s" % (type(e).__name__, e), 'time': time.time() - start}
+
+def convert_batch(inputs, outdir, jobs=1, force=False):
+    '''converts inputs into outdir with jobs worker processes, skipping the
+    outputs that are up to date, and returns the result of every file.
+    Raises ValueError, before anything is converted, if two inputs have the
+    same output, as x.dot and x.gml or a/x.dot and b/x.dot do.'''
+    owners = {}
+    for input in inputs:
+        output = output_of(input, outdir)
+        if output in owners:
+            raise ValueError("%s and %s would both be written to %s" % (owners[output], input, output))
+        owners[output] = input
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    manifest = os.path.join(outdir, MANIFEST)
+    hashes = {}
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            hashes = json.load(f)
+    results = []
+    tasks = []
+    for input in inputs:
+        output = output_of(input, outdir)
+        if not force and up_to_date(input, output, hashes):
+            results.append({'input': input, 'output': output, 'status': 'skipped'})
+        else:
+            tasks.append((input, output))
+    if jobs > 1 and len(tasks) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
+        try:
+            converted = list(pool.imap_unordered(convert_task, tasks))
+            pool.close()
+            pool.join()
+        except:
+            pool.terminate()
+            raise
+    else:
+        converted = map(convert_task, tasks)
+    for r in converted:
+        if r['status'] == 'ok':
+            hashes[os.path.abspath(r['input'])] = r.pop('hash')
+        results.append(r)
+    with open(manifest, 'w') as f:
+        json.dump(hashes, f, indent=1, sort_keys=True)
+    return results
+
+def summary(results, wall, f=sys.stderr):
+    converted = [r for r in results if r['status'] == 'ok']
+    failed = [r for r in results if r['status'] == 'failed']
+    skipped = len(results) - len(converted) - len(failed)
+    edges = sum(r['edges'] for r in converted)
+    size = sum(r['bytes'] for r in converted)
+    f.write("%d converted, %d skipped, %d failed in %.3fs\n" % (len(converted), skipped, len(failed), wall))
+    if converted and wall > 0:
+        f.write("%d edges (%.0f edges/s), %.2f MB read (%.2f MB/s)\n" %
+                (edges, edges / wall, size / 1e6, size / 1e6 / wall))
+    for r in failed:
+        f.write("FAILED %s: %s\n" % (r['input'], r['error']))
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("-i", "--in", dest='input', action='store',
-                        default=None,
-                        help='path to input file (in DOT format)'
+                        nargs='+', default=None,
+                        help='path to input file (in DOT or GML format); with -d, any number of files, globs or directories'
                         )
     parser.add_argument("-o", "--out", dest='output', action='store',
                         default=None,
                         help='path to output file'
                         )
-    return parser.parse_args()
+    parser.add_argument("-d", "--outdir", dest='outdir', action='store',
+                        default=None,
+                        help='convert all inputs into this directory (batch mode); no two of them may have the same name but for their directory and extension'
+                        )
+    parser.add_argument("-j", "--jobs", dest='jobs', action='store',
+                        default=1, type=int,
+                        help='number of worker processes in batch mode'
+                        )
+    parser.add_argument("--force", dest='force', action='store_true',
+                        help='convert even the inputs whose outputs are up to date'
+                        )
+    parser.add_argument("--profile", dest='profile', action='store',
+                        nargs='?', const='table', default=None,
+                        choices=['table', 'json'],
+                        help='print per-phase timings to stderr')
+    parser.add_argument("--pstats", dest='pstats', action='store',
+                        default=None,
+                        help='run under cProfile and dump the stats to this file')
+    return parser, parser.parse_args()
 
 
 if __name__ == "__main__":
-    args = parse_args()
+    parser, args = parse_args()
 
     if not args.input:
         print "Need to specify an input file with -i or --in"
         exit(1)
 
-    graph = nx.Graph(nx.read_dot(args.input))
-    digraph = convert(graph)
+    if args.outdir:
+        start = time.time()
+        try:
+            results = convert_batch(expand_inputs(args.input), args.outdir, args.jobs, args.force)
+        except ValueError as e:
+            parser.error(str(e))
+        summary(results, time.time() - start)
+        if [r for r in results if r['status'] == 'failed']:
+            exit(1)
+        exit(0)
+
+    if len(args.input) > 1:
+        print "Use -d or --outdir to convert several inputs"
+        exit(1)
+    args.input = args.input[0]
+
+    profile = profiling.Profile(args.profile is not None, args.pstats)
+    profile.start()
+    # the nodes are read first; the edges are streamed from a second pass
+    # straight to the output
+    with profile.phase('nodes'):
+        topo = streamreader.Topology(args.input)
 
     if not args.output:
         print "You can specify an output file with -o or --out"
-        print nx.to_agraph(digraph)
+        with profile.phase('edges'):
+            dotwriter.write_dot(sys.stdout, topo.name, topo.nodes.iteritems(), symmetric(topo.edges(), topo.kind))
+        profile.report(sys.stderr, args.profile)
         exit(1)
     else:
-        nx.write_dot(digraph,args.output)
+        with profile.phase('edges'):
+            with open(args.output, 'w') as f:
+                dotwriter.write_dot(f, topo.name, topo.nodes.iteritems(), symmetric(topo.edges(), topo.kind))
+        profile.report(sys.stderr, args.profile)
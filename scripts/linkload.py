@@ -0,0 +1,206 @@
+#!/usr/bin/python
+
+'''This file pushes a traffic matrix through the forwarding tables of an AB
+fat tree and reports how it loads the links:
+
+  linkload.py 8 3 -m all
+  linkload.py 16 3 -m perm -f fail --fail-link s1 s129
+
+The tables are the rules of -t tables of abfattree.py, with or without
+failover. Flows are forwarded hop by hop as NumPy arrays, a batch of
+source hosts at a time. As in the union of the NetKAT policy, a packet is
+sent by every rule that matches it. A failover rule sends on its backup
+port only while the link of its port is down, as in forwarding.forward.
+Rates are fractions of the host link capacity.
+
+The report gives the load of every link class, the most loaded links and
+the traffic that is dropped. The throughput is the total rate once the
+matrix is scaled down until no link is over capacity. The effective
+bisection bandwidth is the part of it that crosses between the two halves
+of the hosts, also as a fraction of the full bisection of H/2 host links
+each way.'''
+
+import sys
+import json
+import argparse
+import numpy as np
+import abfattree
+import forwarding
+from fattree import capacity_bps
+
+def push(graph, classifier, dead, src, dst, rate, load):
+    '''forwards the flows (src, dst, rate) of host indices, adds their rates
+    to load, indexed by node*stride + port, and returns the delivered,
+    dropped and looping rates'''
+    totals = dict.fromkeys(['delivered', 'wrong', 'dropped', 'looping'], 0.0)
+    for event in forwarding.forward(graph, classifier, dead, src, dst):
+        if event[0] == 'link':
+            load += np.bincount(event[3], rate[event[1]] * event[2], len(load))
+        else:
+            totals[event[0]] += (rate[event[1]] * event[2]).sum()
+    return totals['delivered'], totals['dropped'] + totals['wrong'], totals['looping']
+
+def traffic(graph, matrix, rate, seed, batch):
+    '''yields batches (src, dst, rate) of host indices for matrix: all (every
+    host sends rate split over all the others), perm (a random permutation
+    without fixed points), random (a random destination per host) or a file
+    of "src dst rate" lines with host names'''
+    H = graph.nhosts
+    rng = np.random.RandomState(seed)
+    if matrix == 'all':
+        step = max(1, batch / max(1, H - 1))
+        for first in range(0, H, step):
+            src = np.repeat(np.arange(first, min(H, first + step)), H)
+            dst = np.tile(np.arange(H), len(src) / H)
+            keep = src != dst
+            yield src[keep], dst[keep], np.full(keep.sum(), rate / (H - 1))
+        return
+    if matrix == 'perm':
+        dst = rng.permutation(H)
+        while H > 1 and (dst == np.arange(H)).any():
+            dst = rng.permutation(H)
+        src = np.arange(H)
+    elif matrix == 'random':
+        src = np.arange(H)
+        dst = (src + rng.randint(1, max(2, H), H)) % H
+    else:
+        srcs, dsts, rates = [], [], []
+        with open(matrix) as f:
+            for line in f:
+                fields = line.split('#')[0].split()
+                if not fields:
+                    continue
+                srcs.append(graph.node(fields[0]) - graph.nswitches)
+                dsts.append(graph.node(fields[1]) - graph.nswitches)
+                rates.append(float(fields[2]) if len(fields) > 2 else rate)
+        src, dst = np.array(srcs, np.int64), np.array(dsts, np.int64)
+        for first in range(0, len(src), batch):
+            yield src[first:first+batch], dst[first:first+batch], np.array(rates[first:first+batch])
+        return
+    for first in range(0, H, batch):
+        yield src[first:first+batch], dst[first:first+batch], np.full(len(src[first:first+batch]), rate)
+
+def level_name(graph, node):
+    if graph.is_host(node):
+        return 'host'
+    level = graph.level(node)
+    if level == 0:
+        return 'edge'
+    if level == graph.L:
+        return 'core'
+    if graph.L == 2:
+        return 'agg'
+    return 'agg%d' % (level)
+
+def analyze(graph, matrix, failover=False, links=(), rate=1.0, seed=0, batch=1 << 20):
+    '''returns (load, totals): the load of every port node*stride + port as
+    a fraction of the link capacity, and the demand, delivered, dropped,
+    looping and cut-crossing rates'''
+    classifier = forwarding.Classifier(graph, abfattree.flow_rules(graph, graph.switches, failover))
+    dead = forwarding.failed_ports(graph, links)
+    load = np.zeros(len(dead))
+    totals = dict.fromkeys(['demand', 'delivered', 'dropped', 'looping', 'crossing'], 0.0)
+    half = graph.nhosts / 2
+    for src, dst, r in traffic(graph, matrix, rate, seed, batch):
+        totals['demand'] += r.sum()
+        totals['crossing'] += r[(src < half) != (dst < half)].sum()
+        delivered, dropped, looping = push(graph, classifier, dead, src, dst, r, load)
+        totals['delivered'] += delivered
+        totals['dropped'] += dropped
+        totals['looping'] += looping
+    return load, totals
+
+def report(graph, load, totals, top=10):
+    '''a dict of the link classes, the most loaded links and the throughput'''
+    stride = 2*graph.p + 1
+    capacity = capacity_bps(graph.capacity)
+    used = np.flatnonzero(np.frombuffer(graph.peer, np.int32) >= 0)
+    classes = {}
+    for i in used:
+        node, port = divmod(int(i), stride)
+        name = "%s->%s" % (level_name(graph, node), level_name(graph, graph.peer[i]))
+        classes.setdefault(name, []).append(i)
+    maxutil = float(load[used].max()) if len(used) else 0.0
+    scale = 1.0 / maxutil if maxutil > 1 else 1.0
+    result = {'links': len(used), 'capacity_bps': capacity, 'max_utilization': maxutil,
+              'mean_utilization': float(load[used].mean()), 'classes': {}, 'hottest': [],
+              'totals': totals,
+              'throughput': totals['delivered'] * scale,
+              'bisection': totals['crossing'] * scale,
+              'bisection_fraction': totals['crossing'] * scale / graph.nhosts}
+    for name, idx in sorted(classes.items()):
+        l = load[idx]
+        result['classes'][name] = {'links': len(idx), 'max': float(l.max()), 'mean': float(l.mean()),
+                                   'over': int((l > 1 + 1e-9).sum())}
+    for i in used[np.argsort(-load[used], kind='mergesort')[:top]]:
+        node, port = divmod(int(i), stride)
+        result['hottest'].append({'link': "%s:%d -> %s:%d" % (graph.name(node), port, graph.name(graph.peer[i]),
+                                                               graph.peer_port[i]),
+                                  'utilization': float(load[i])})
+    return result
+
+def write_report(result, f=sys.stdout):
+    cap = result['capacity_bps']
+    t = result['totals']
+    f.write("%d links of %.3g Gbps, max utilization %.3f, mean %.3f\n" %
+            (result['links'], cap / 1e9, result['max_utilization'], result['mean_utilization']))
+    f.write("%-14s %8s %10s %10s %8s\n" % ('class', 'links', 'max', 'mean', 'over'))
+    for name, c in sorted(result['classes'].items()):
+        f.write("%-14s %8d %10.3f %10.3f %8d\n" % (name, c['links'], c['max'], c['mean'], c['over']))
+    f.write("hottest links:\n")
+    for h in result['hottest']:
+        f.write("  %-32s %10.3f\n" % (h['link'], h['utilization']))
+    f.write("demand %.3f, delivered %.3f, dropped %.3f, looping %.3f host links\n" %
+            (t['demand'], t['delivered'], t['dropped'], t['looping']))
+    f.write("throughput %.3f host links (%.3f Gbps)\n" % (result['throughput'], result['throughput'] * cap / 1e9))
+    f.write("effective bisection bandwidth %.3f host links (%.3f Gbps, %.3f of full bisection)\n" %
+            (result['bisection'], result['bisection'] * cap / 1e9, result['bisection_fraction']))
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("fanout", type=int,
+                        help="number of children each node should have")
+    parser.add_argument("depth", type=int,
+                        help="depth of the fattree")
+    parser.add_argument("-m", "--matrix", dest='matrix', action='store',
+                        default='all',
+                        help='traffic matrix: all, perm, random or a file of "src dst [rate]" lines')
+    parser.add_argument("-r", "--rate", dest='rate', action='store', type=float,
+                        default=1.0,
+                        help='rate each host sends, as a fraction of its link capacity')
+    parser.add_argument("-f", "--ft", dest='failover', action='store',
+                        choices=['nofail', 'fail'], default='nofail',
+                        help='use the failover tables')
+    parser.add_argument("--fail-link", dest='faillinks', action='append',
+                        nargs=2, metavar=('A', 'B'), default=[],
+                        help='take the link between nodes A and B (e.g. s1 s9) down')
+    parser.add_argument("--seed", dest='seed', action='store', type=int,
+                        default=0,
+                        help='seed of the perm and random matrices')
+    parser.add_argument("--batch", dest='batch', action='store', type=int,
+                        default=1 << 20,
+                        help='flows forwarded at once')
+    parser.add_argument("--top", dest='top', action='store', type=int,
+                        default=10,
+                        help='number of most loaded links to list')
+    parser.add_argument("--json", dest='json', action='store_true',
+                        help='write the report as JSON')
+    return parser, parser.parse_args()
+
+
+if __name__ == "__main__":
+    parser, args = parse_args()
+    graph = abfattree.generate(args.fanout, args.depth)
+    abfattree.compute_routes(graph)
+    try:
+        links = [(graph.node(a), graph.node(b)) for a, b in args.faillinks]
+        forwarding.failed_ports(graph, links)
+    except ValueError as e:
+        parser.error(str(e))
+    load, totals = analyze(graph, args.matrix, args.failover == 'fail', links, args.rate, args.seed, args.batch)
+    result = report(graph, load, totals, args.top)
+    if args.json:
+        json.dump(result, sys.stdout, indent=1, sort_keys=True)
+        print
+    else:
+        write_report(result)
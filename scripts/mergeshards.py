@@ -0,0 +1,67 @@
+#!/usr/bin/python
+
+'''This file merges the shards written by abfattree.py --shard i/N into the
+policy abfattree.py writes without --shard, byte for byte:
+
+  for i in 0 1 2 3; do abfattree.py 16 3 -n -t paths --shard $i/4 -k s$i; done
+  mergeshards.py s0 s1 s2 s3 -k paths.kat
+
+The terms of the shards are copied in shard order; the rest of the policy,
+which only depends on the tree, is generated again.'''
+
+import sys
+import argparse
+import abfattree
+import profiling
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("shards", nargs='+',
+                        help='files of abfattree.py --shard, one per shard, in any order')
+    parser.add_argument("-k", "--kat", dest='katfile', action='store',
+                        default=None,
+                        help='file to write the merged NetKAT policy to (default: stdout)')
+    parser.add_argument("--profile", dest='profile', action='store',
+                        nargs='?', const='table', default=None,
+                        choices=['table', 'json'],
+                        help='report the time and memory of every phase on stderr')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    profile = profiling.Profile(args.profile is not None)
+    profile.start()
+
+    files = {}
+    config = None
+    nshards = None
+    for path in args.shards:
+        f = open(path)
+        i, n, c = abfattree.read_shard_header(f)
+        if config is None:
+            config, nshards = c, n
+        elif (c, n) != (config, nshards):
+            print >> sys.stderr, "%s is a shard of another policy" % (path)
+            exit(1)
+        if i in files:
+            print >> sys.stderr, "shard %d is given twice" % (i)
+            exit(1)
+        files[i] = f
+    missing = [i for i in range(nshards) if i not in files]
+    if missing:
+        print >> sys.stderr, "missing shards %s of %d" % (", ".join(map(str, missing)), nshards)
+        exit(1)
+
+    with profile.phase('generate'):
+        graph = abfattree.generate(config['fanout'], config['depth'])
+    graph.prefixes = config['prefixes']
+    graph.merge = [files[i] for i in range(nshards)]
+    graph.sections = 0
+    abfattree.to_netkat(graph, config['kattype'], args.katfile, config['failover'], config['local'],
+                        profile=profile)
+    for f in graph.merge:
+        if next(f, None) is not None:
+            print >> sys.stderr, "%s has more sections than the policy" % (f.name)
+            exit(1)
+    profile.report(sys.stderr, args.profile)
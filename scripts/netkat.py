@@ -0,0 +1,540 @@
+#!/usr/bin/python
+
+'''NetKAT policies as hash-consed nodes, and the backends that write them.
+
+A policy is a DAG of nodes: filter, mod, seq, union, star, link and group
+(a parenthesized policy) over the predicates test, not, and and or. A
+constructor returns the node that already exists for the same operator
+and arguments, if there is one, so an equal subterm is one object, and is
+rendered once by a backend however often a policy repeats it: the switch
+filters, host exclusions, actions and paths of abfattree.py. Nodes are
+held weakly by the table, so a node lives only as long as a policy or a
+generator uses it. The constructors do not simplify, so a policy is
+written exactly as it was built; a seq or union of one policy is that
+policy.
+
+A term that is built once and written once, such as a table entry, is
+made by a form or by term() instead, over shared nodes. form() compiles
+the shape of such terms once; called on the shared nodes, a form returns
+the text of its term, formatted in one step from the text the nodes keep,
+and term() renders its one operator the same way. While write_binary
+runs, forms and term() build nodes that are not interned instead, so the
+binary backend has the structure of every term. A stream is a union whose
+terms come from a generator, such as the millions of entries of a policy;
+a backend writes them one at a time as they come. A term of a stream can
+be a string of NetKAT text, as a form or a shard file gives it; only the
+text backend writes those.
+
+write_text writes NetKAT with the parentheses of the group nodes only,
+and the terms of a stream one per line. A union of modifications, the
+actions of a rule, is written with +. write_binary writes every node
+once, after its arguments, as a record that is referred to by its index,
+all little endian:
+
+  header  magic 'NKIR', version (uint32)
+  record  operator (uint8), n (uint32), then n bytes for a string, an
+          int64 for an integer, or n uint32 indices of earlier records
+
+The arguments of test, mod and link are string and integer records. The
+last record is the policy. read() loads a file back into nodes, and
+netkat.py file writes it as text.'''
+
+import sys
+import struct
+import string
+import weakref
+import argparse
+from array import array
+
+class Node(object):
+    '''op and its arguments: nodes, or the fields and values of a test, mod
+    or link. Nodes are only built by the constructors, so they compare by
+    identity; lazy, text and ref are the caches of the backends.'''
+
+    __slots__ = ('op', 'args', 'lazy', 'text', 'ref', '__weakref__')
+
+    def __repr__(self):
+        if _streams(self):
+            return "<netkat %s with a stream>" % (self.op)
+        return "<netkat %s>" % (text(self))
+
+class Term(Node):
+    '''a node of a form or of term() while write_binary runs, which is not
+    interned and keeps no caches'''
+
+    __slots__ = ()
+    lazy = None
+    text = None
+    ref = None
+
+class Ref(weakref.ref):
+    __slots__ = ('key',)
+
+# the live nodes, by (op,) + args
+_nodes = {}
+
+def _remove(ref, nodes=_nodes):
+    if nodes.get(ref.key) is ref:
+        del nodes[ref.key]
+
+def make(op, args):
+    '''the node of op and the tuple args'''
+    key = (op,) + args
+    ref = _nodes.get(key)
+    if ref is not None:
+        node = ref()
+        if node is not None:
+            return node
+    node = Node.__new__(Node)
+    node.op = op
+    node.args = args
+    node.lazy = None
+    node.text = None
+    node.ref = None
+    ref = _nodes[key] = Ref(node, _remove)
+    ref.key = key
+    return node
+
+# whether forms and term() build nodes, as they do for write_binary, and
+# not text
+_building = False
+
+def _term(op, args):
+    node = Term.__new__(Term)
+    node.op = op
+    node.args = args
+    return node
+
+def term(op, *args):
+    '''the text of op over args, for a term that is built and written once,
+    or a node of it that is not interned while write_binary runs'''
+    if _building:
+        return _term(op, args)
+    return _render(op, args)
+
+def form(shape):
+    '''compiles shape, a tuple (op, arg, ...) whose args are shapes, nodes
+    or the slot numbers 0, 1, ... in the order they are written, into a
+    function of the slots: it returns the text of the term, or while
+    write_binary runs, its nodes. A slot is a node, text or, in a test, mod
+    or link, a value. A union in a shape is written with + only if all of
+    its arguments are mod shapes.'''
+    slots = []
+    fmt = _form_text(shape, slots)
+    if slots != range(len(slots)):
+        raise ValueError("the slots of %r are not in order" % (shape,))
+    def build(*args):
+        if _building:
+            return _build(shape, args)
+        return fmt % tuple([a.text or text(a) if a.__class__ is Node else a for a in args])
+    return build
+
+def _form_text(shape, slots):
+    if isinstance(shape, int):
+        slots.append(shape)
+        return "%s"
+    if isinstance(shape, Node):
+        return text(shape).replace("%", "%%")
+    op = shape[0]
+    texts = [_form_text(a, slots) for a in shape[1:]]
+    mods = op == 'union' and all([isinstance(a, tuple) and a[0] == 'mod' for a in shape[1:]])
+    return _render_texts(op, texts, mods)
+
+def _build(shape, args):
+    if isinstance(shape, int):
+        return args[shape]
+    if isinstance(shape, Node):
+        return shape
+    return _term(shape[0], tuple([_build(a, args) for a in shape[1:]]))
+
+ID = make('id', ())
+DROP = make('drop', ())
+TRUE = make('true', ())
+FALSE = make('false', ())
+
+def test(field, value):
+    return make('test', (field, value))
+
+def neg(pred):
+    return make('not', (pred,))
+
+def conj(*preds):
+    return _nary('and', preds, TRUE)
+
+def disj(*preds):
+    return _nary('or', preds, FALSE)
+
+def filter(pred):
+    return make('filter', (pred,))
+
+def mod(field, value):
+    return make('mod', (field, value))
+
+def seq(*pols):
+    return _nary('seq', pols, ID)
+
+def union(*pols):
+    return _nary('union', pols, DROP)
+
+def star(pol):
+    return make('star', (pol,))
+
+def link(sw1, pt1, sw2, pt2):
+    return make('link', (sw1, pt1, sw2, pt2))
+
+def group(pol, spaced=False):
+    '''pol in parentheses, with a space inside them if spaced is set'''
+    return make('spaced' if spaced else 'group', (pol,))
+
+def stream(terms):
+    '''the union of terms, which are only produced when it is written'''
+    return _term('stream', (terms,))
+
+def _nary(op, args, unit):
+    if not args:
+        return unit
+    if len(args) == 1:
+        return args[0]
+    return make(op, tuple(args))
+
+#########
+#TEXT
+#########
+
+# the operators whose arguments are strings and integers, not nodes
+ATOMS = ('test', 'mod', 'link')
+
+# the text of an operator, of the text of its arguments
+SHAPES = {'id': "id", 'drop': "drop", 'true': "true", 'false': "false",
+          'test': "%s = %s", 'mod': "%s := %s", 'link': "%s@%s => %s@%s",
+          'not': "not %s", 'filter': "filter %s", 'star': "%s*",
+          'group': "(%s)", 'spaced': "( %s )"}
+JOINS = {'and': " and ", 'or': " or ", 'seq': "; ", 'union': " | "}
+
+def _render_texts(op, texts, mods=False):
+    '''the text of op over texts; a union of mods is written with +'''
+    sep = JOINS.get(op)
+    if sep is None:
+        return SHAPES[op] % tuple(texts)
+    if mods:
+        sep = " + "
+    return sep.join(texts)
+
+def _render(op, args):
+    if op in ATOMS:
+        return SHAPES[op] % args
+    mods = op == 'union'
+    texts = []
+    for p in args:
+        if p.__class__ is str:
+            mods = False
+        else:
+            mods = mods and p.op == 'mod'
+            p = p.text or text(p)
+        texts.append(p)
+    return _render_texts(op, texts, mods)
+
+def text(node):
+    '''the NetKAT text of node, which has no streams, on one line; a string
+    is text already. Only the text of an interned node is kept.'''
+    if node.__class__ is str:
+        return node
+    s = node.text
+    if s is None:
+        s = _render(node.op, node.args)
+        if node.__class__ is Node:
+            node.text = s
+    return s
+
+def _streams(node):
+    '''whether node has a stream in it'''
+    if node.__class__ is str:
+        return False
+    if node.__class__ is Term:
+        return node.op == 'stream' or any([_streams(p) for p in node.args if p.__class__ is Node])
+    if node.lazy is None:
+        if node.op == 'stream':
+            node.lazy = True
+        elif node.op in ('seq', 'union', 'star', 'group', 'spaced'):
+            node.lazy = any([_streams(p) for p in node.args])
+        else:
+            node.lazy = False
+    return node.lazy
+
+class TextWriter(object):
+    '''writes text to f, in writes of about bufsize bytes'''
+
+    def __init__(self, f, bufsize=1 << 16):
+        self.f = f
+        self.bufsize = bufsize
+        self.buf = []
+        self.size = 0
+
+    def flush(self):
+        self.f.write(string.join(self.buf, ""))
+        self.buf = []
+        self.size = 0
+
+    def write(self, s):
+        self.buf.append(s)
+        self.size += len(s)
+        if self.size >= self.bufsize:
+            self.flush()
+
+    def policy(self, node):
+        '''writes the text of node. The terms of a stream are written one
+        per line, and a seq with a stream in it has one part per line.'''
+        if not _streams(node):
+            self.write(text(node))
+            return
+        op = node.op
+        if op == 'stream':
+            self.stream(node.args[0])
+        elif op == 'group' or op == 'spaced':
+            p = node.args[0]
+            nl = "\n" if p.op == 'stream' else " " if op == 'spaced' else ""
+            self.write("(" + nl)
+            self.policy(p)
+            self.write(nl + ")")
+        elif op == 'star':
+            self.policy(node.args[0])
+            self.write("*")
+        else:
+            sep = ""
+            for p in node.args:
+                self.write(sep)
+                self.policy(p)
+                sep = " |\n" if op == 'union' else ";\n"
+
+    def stream(self, terms):
+        buf = self.buf
+        size = self.size
+        sep = ""
+        for t in terms:
+            if t.__class__ is not str:
+                t = text(t)
+            buf.append(sep)
+            buf.append(t)
+            size += len(t) + 3
+            sep = " |\n"
+            if size >= self.bufsize:
+                self.flush()
+                buf = self.buf
+                size = 0
+        self.size = size
+
+def write_chunks(chunks, f, bufsize=1 << 20):
+    '''writes chunks to f, in writes of about bufsize bytes'''
+    buf = []
+    size = 0
+    for s in chunks:
+        buf.append(s)
+        size += len(s)
+        if size >= bufsize:
+            f.write(string.join(buf, ""))
+            buf = []
+            size = 0
+    f.write(string.join(buf, ""))
+
+def write_text(policy, f):
+    '''writes the NetKAT text of policy to f; a policy that is a stream
+    ends with a newline, as every term of it is a line'''
+    writer = TextWriter(f)
+    writer.policy(policy)
+    if policy.__class__ is not str and policy.op == 'stream':
+        writer.write("\n")
+    writer.flush()
+
+#########
+#BINARY
+#########
+
+MAGIC = 'NKIR'
+VERSION = 1
+
+HEADER = struct.Struct('<4sI')
+RECORD = struct.Struct('<BI')
+INT = struct.Struct('<q')
+
+OPS = ['string', 'int', 'id', 'drop', 'true', 'false', 'test', 'not', 'and', 'or',
+       'filter', 'mod', 'seq', 'union', 'star', 'link', 'stream', 'group', 'spaced']
+CODES = dict((op, code) for code, op in enumerate(OPS))
+
+def _indices(refs):
+    if sys.byteorder != 'little':
+        refs.byteswap()
+    return refs.tostring()
+
+class BinaryWriter(object):
+    '''writes the records of nodes to f, every node once. A node written
+    by this writer keeps its index in node.ref, but for a term; the writer
+    itself keeps no node, so a node that dies and is built again is written
+    again.'''
+
+    def __init__(self, f, bufsize=1 << 20):
+        self.f = f
+        self.bufsize = bufsize
+        self.buf = []
+        self.size = 0
+        self.count = 0
+        self.atoms = {}
+        # marks the indices of this writer
+        self.token = object()
+        f.write(HEADER.pack(MAGIC, VERSION))
+
+    def record(self, op, n, payload):
+        self.buf.append(RECORD.pack(CODES[op], n))
+        self.buf.append(payload)
+        self.size += RECORD.size + len(payload)
+        if self.size >= self.bufsize:
+            self.flush()
+        self.count += 1
+        return self.count - 1
+
+    def atom(self, value):
+        '''the index of the record of a string or an integer'''
+        key = (value.__class__, value)
+        i = self.atoms.get(key)
+        if i is None:
+            if isinstance(value, str):
+                i = self.record('string', len(value), value)
+            else:
+                i = self.record('int', 0, INT.pack(value))
+            self.atoms[key] = i
+        return i
+
+    def index(self, node):
+        '''the index of the record of node, which is written after the ones
+        of its arguments if it is not written yet'''
+        if node.__class__ is str:
+            raise ValueError("a term of NetKAT text cannot be written as nodes")
+        ref = node.ref
+        if ref is not None and ref[0] is self.token:
+            return ref[1]
+        if node.op == 'stream':
+            refs = array('I')
+            for term in node.args[0]:
+                refs.append(self.index(term))
+        elif node.op in ATOMS:
+            refs = array('I', [self.atom(v) for v in node.args])
+        else:
+            refs = array('I', [self.index(p) for p in node.args])
+        i = self.record(node.op, len(refs), _indices(refs))
+        if node.__class__ is Node:
+            node.ref = (self.token, i)
+        return i
+
+    def flush(self):
+        self.f.write(string.join(self.buf, ""))
+        self.buf = []
+        self.size = 0
+
+def write_binary(policy, f):
+    '''writes the nodes of policy to f; the forms and term() of the
+    generators of its streams build nodes meanwhile'''
+    global _building
+    writer = BinaryWriter(f)
+    _building = True
+    try:
+        writer.index(policy)
+    finally:
+        _building = False
+    writer.flush()
+
+BUILD = {
+    'id': lambda: ID,
+    'drop': lambda: DROP,
+    'true': lambda: TRUE,
+    'false': lambda: FALSE,
+    'test': test,
+    'not': neg,
+    'and': conj,
+    'or': disj,
+    'filter': filter,
+    'mod': mod,
+    'seq': seq,
+    'union': union,
+    'star': star,
+    'link': link,
+    'stream': lambda *terms: stream(terms),
+    'group': group,
+    'spaced': lambda pol: group(pol, True),
+}
+
+def records(f):
+    '''yields (op, value) for the records of a file of write_binary: the
+    string, the integer or the array of indices of the record'''
+    name = getattr(f, 'name', 'input')
+    data = f.read()
+    if len(data) < HEADER.size or HEADER.unpack_from(data)[0] != MAGIC:
+        raise ValueError("%s is not a NetKAT node file" % (name))
+    if HEADER.unpack_from(data)[1] != VERSION:
+        raise ValueError("%s is not a version %d NetKAT node file" % (name, VERSION))
+    off = HEADER.size
+    while off < len(data):
+        if off + RECORD.size > len(data):
+            raise ValueError("%s is truncated" % (name))
+        code, n = RECORD.unpack_from(data, off)
+        off += RECORD.size
+        if code >= len(OPS):
+            raise ValueError("%s: unknown operator %d" % (name, code))
+        op = OPS[code]
+        size = n if op == 'string' else INT.size if op == 'int' else 4 * n
+        if off + size > len(data):
+            raise ValueError("%s is truncated" % (name))
+        if op == 'string':
+            yield op, data[off:off + n]
+        elif op == 'int':
+            yield op, INT.unpack_from(data, off)[0]
+        else:
+            refs = array('I', data[off:off + size])
+            if sys.byteorder != 'little':
+                refs.byteswap()
+            yield op, refs
+        off += size
+
+def read(f):
+    '''the policy of a file of write_binary, as nodes'''
+    values = []
+    for op, value in records(f):
+        if op == 'string' or op == 'int':
+            values.append(value)
+        else:
+            values.append(BUILD[op](*[values[i] for i in value]))
+    if not values:
+        raise ValueError("%s has no policy" % (getattr(f, 'name', 'input')))
+    return values[-1]
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input",
+                        help="file of NetKAT nodes, as written by abfattree.py --format binary")
+    parser.add_argument("-o", "--out", dest='output', action='store',
+                        default=None,
+                        help='file to write the text to')
+    parser.add_argument("-s", "--stats", dest='stats', action='store_true',
+                        help='print the number of records of every operator instead')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    with open(args.input, 'rb') as f:
+        if args.stats:
+            counts = dict.fromkeys(OPS, 0)
+            terms = 0
+            for op, value in records(f):
+                counts[op] += 1
+                if op != 'string' and op != 'int':
+                    terms += len(value)
+            for op in OPS:
+                if counts[op]:
+                    print "%-8s %10d" % (op, counts[op])
+            print "%-8s %10d records, %d references" % ('total', sum(counts.values()), terms)
+            exit(0)
+        policy = read(f)
+    if args.output:
+        with open(args.output, 'w') as f:
+            write_text(policy, f)
+    else:
+        write_text(policy, sys.stdout)
@@ -0,0 +1,123 @@
+'''Instrumentation for the generator scripts, enabled with --profile.
+
+A Profile records the wall time, CPU time and peak RSS of named phases,
+counts the calls to selected hot functions and can run the whole script
+under cProfile. When it is disabled every hook is a no-op, so the scripts
+can use it unconditionally.'''
+
+import os
+import sys
+import json
+import time
+import resource
+import functools
+from contextlib import contextmanager
+
+def cpu_time():
+    '''user + system time of this process and of its reaped children (the
+    --jobs workers)'''
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+def maxrss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def children_maxrss():
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+class TimedFile(object):
+    '''file wrapper that adds the time spent in write() to a phase'''
+
+    def __init__(self, f, profile, name):
+        self.f = f
+        self.profile = profile
+        self.name = name
+
+    def write(self, s):
+        wall = time.time()
+        cpu = cpu_time()
+        self.f.write(s)
+        self.profile.add(self.name, time.time() - wall, cpu_time() - cpu)
+
+class Profile(object):
+
+    def __init__(self, enabled=True, pstats=None):
+        self.enabled = enabled or pstats is not None
+        self.pstats = pstats
+        self.phases = []
+        self.totals = {}
+        self.calls = {}
+        self.cprofile = None
+
+    def start(self):
+        if self.pstats:
+            import cProfile
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    def add(self, name, wall, cpu):
+        '''adds wall and cpu seconds to phase name'''
+        if name not in self.totals:
+            self.totals[name] = {'phase': name, 'wall': 0.0, 'cpu': 0.0}
+            self.phases.append(self.totals[name])
+        entry = self.totals[name]
+        entry['wall'] += wall
+        entry['cpu'] += cpu
+        entry['maxrss_kb'] = maxrss()
+        entry['children_maxrss_kb'] = children_maxrss()
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        wall = time.time()
+        cpu = cpu_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - wall, cpu_time() - cpu)
+
+    def timed(self, f, name):
+        if not self.enabled:
+            return f
+        return TimedFile(f, self, name)
+
+    def count_calls(self, namespace, names):
+        '''replaces the functions names in namespace (a module's globals())
+        by wrappers that count their calls. Calls made by worker processes
+        are not counted.'''
+        if not self.enabled:
+            return
+        for name in names:
+            namespace[name] = self.counted(name, namespace[name])
+
+    def counted(self, name, fn):
+        self.calls[name] = 0
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            self.calls[name] += 1
+            return fn(*args, **kwargs)
+        return wrapper
+
+    def report(self, f=sys.stderr, fmt='table'):
+        '''stops cProfile, dumps its stats and writes the summary to f'''
+        if not self.enabled:
+            return
+        if self.cprofile:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.pstats)
+        if fmt == 'json':
+            json.dump({'phases': self.phases, 'calls': self.calls}, f, indent=1, sort_keys=True)
+            f.write("\n")
+            return
+        f.write("%-16s %10s %10s %12s %12s\n" % ('phase', 'wall', 'cpu', 'maxrss_kb', 'children_kb'))
+        for entry in self.phases:
+            f.write("%-16s %10.3f %10.3f %12d %12d\n" % (entry['phase'], entry['wall'], entry['cpu'],
+                                                       entry['maxrss_kb'], entry['children_maxrss_kb']))
+        if self.calls:
+            f.write("%-32s %12s\n" % ('function', 'calls'))
+            for name in sorted(self.calls):
+                f.write("%-32s %12d\n" % (name, self.calls[name]))
+        if self.pstats:
+            f.write("cProfile stats written to %s\n" % (self.pstats))
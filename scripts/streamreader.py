@@ -0,0 +1,295 @@
+'''Streaming readers for DOT and GML topologies.
+
+dot_events and gml_events tokenize a file as it is read and yield
+('graph', name, kind), ('node', name, attrs) and ('edge', src, dst, attrs)
+events without building a graph. kind is the DOT header, 'graph',
+'digraph', 'strict graph' or 'strict digraph'; a GML graph is a digraph
+if it is directed. Topology reads a file in two passes: the
+first keeps the nodes and their attributes, the second streams the edges
+again, so only the node set is held in memory.
+
+GML files (e.g. from the Topology Zoo) are mapped the way lib/Parsers.ml
+reads them: nodes are switches named by their label, a link from source
+to target leaves on port target and arrives on port source.'''
+
+import re
+import itertools
+from collections import OrderedDict
+
+# a numeral runs on into letters, so an unquoted 1Gbps is one ID
+DOT_TOKEN = re.compile(r'''
+    (?P<skip>\s+|//[^\n]*|\#[^\n]*|/\*.*?\*/)
+  | (?P<str>"(?:[^"\\]|\\.)*")
+  | (?P<edgeop>--|->)
+  | (?P<id>[A-Za-z_\x80-\xff][A-Za-z0-9_\x80-\xff]*|-?(?:\.[0-9]+|[0-9][A-Za-z0-9_.]*))
+  | (?P<punct>[{}\[\];,=:])
+''', re.X | re.S)
+
+GML_TOKEN = re.compile(r'''
+    (?P<skip>\s+|\#[^\n]*)
+  | (?P<str>"[^"]*")
+  | (?P<num>[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?)
+  | (?P<id>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<punct>[\[\]])
+''', re.X | re.S)
+
+# a token that may continue on the next line
+UNFINISHED = re.compile(r'"|/\*')
+
+class ParseError(Exception):
+    pass
+
+def tokens(f, regex):
+    '''yields (kind, text) for the tokens of the lines of f. Only a quoted
+    string or a comment that is not closed yet is carried to the next line.'''
+    buf = ""
+    for line in f:
+        buf += line
+        pos = 0
+        while pos < len(buf):
+            m = regex.match(buf, pos)
+            if m is None:
+                if UNFINISHED.match(buf, pos):
+                    break
+                raise ParseError("unexpected %r" % (buf[pos:pos+20]))
+            pos = m.end()
+            if m.lastgroup != 'skip':
+                yield m.lastgroup, m.group(m.lastgroup)
+        buf = buf[pos:]
+    if buf.strip():
+        raise ParseError("unterminated %r" % (buf[:20]))
+
+def dot_string(text):
+    if text[0] == '"':
+        return text[1:-1].replace('\\"', '"')
+    return text
+
+class TokenStream(object):
+
+    def __init__(self, toks):
+        self.toks = toks
+        self.ahead = []
+
+    def peek(self):
+        if not self.ahead:
+            self.ahead.append(next(self.toks, (None, None)))
+        return self.ahead[0]
+
+    def next(self):
+        tok = self.peek()
+        self.ahead.pop(0)
+        return tok
+
+    def expect(self, text):
+        kind, t = self.next()
+        if t != text:
+            raise ParseError("expected %r, got %r" % (text, t))
+
+def dot_attrs(ts):
+    '''parses a sequence of [a=b, ...] lists'''
+    attrs = {}
+    while ts.peek()[1] == '[':
+        ts.next()
+        while ts.peek()[1] != ']':
+            kind, key = ts.next()
+            if kind not in ('id', 'str'):
+                raise ParseError("expected an attribute, got %r" % (key))
+            if ts.peek()[1] == '=':
+                ts.next()
+                attrs[dot_string(key)] = dot_string(ts.next()[1])
+            else:
+                attrs[dot_string(key)] = 'true'
+            if ts.peek()[1] in (',', ';'):
+                ts.next()
+        ts.expect(']')
+    return attrs
+
+def dot_node_id(ts):
+    kind, name = ts.next()
+    if kind not in ('id', 'str'):
+        raise ParseError("expected a node, got %r" % (name))
+    # ports are ignored
+    while ts.peek()[1] == ':':
+        ts.next()
+        ts.next()
+    return dot_string(name)
+
+def dot_events(f):
+    '''yields the events of a DOT file. Node and edge defaults are applied,
+    subgraphs are flattened, and a subgraph cannot be an edge endpoint.'''
+    ts = TokenStream(tokens(f, DOT_TOKEN))
+    strict = ts.peek()[1] == 'strict'
+    if strict:
+        ts.next()
+    kind, t = ts.next()
+    if t not in ('graph', 'digraph'):
+        raise ParseError("expected graph or digraph, got %r" % (t))
+    name = None
+    if ts.peek()[1] != '{':
+        name = dot_string(ts.next()[1])
+    yield ('graph', name, 'strict ' + t if strict else t)
+    ts.expect('{')
+    node_defaults = {}
+    edge_defaults = {}
+    depth = 1
+    while depth:
+        kind, t = ts.next()
+        if kind is None:
+            raise ParseError("unexpected end of file")
+        if t in (';', ','):
+            continue
+        if t == '}':
+            depth -= 1
+        elif t == '{':
+            depth += 1
+        elif t == 'subgraph':
+            if ts.peek()[1] != '{':
+                ts.next()
+        elif t in ('graph', 'node', 'edge') and kind == 'id' and ts.peek()[1] == '[':
+            attrs = dot_attrs(ts)
+            if t == 'node':
+                node_defaults.update(attrs)
+            elif t == 'edge':
+                edge_defaults.update(attrs)
+        elif ts.peek()[1] == '=':
+            # graph attribute
+            ts.next()
+            ts.next()
+        else:
+            ts.ahead.insert(0, (kind, t))
+            nodes = [dot_node_id(ts)]
+            while ts.peek()[0] == 'edgeop':
+                ts.next()
+                nodes.append(dot_node_id(ts))
+            attrs = dot_attrs(ts)
+            if len(nodes) == 1:
+                node = dict(node_defaults)
+                node.update(attrs)
+                yield ('node', nodes[0], node)
+            else:
+                edge = dict(edge_defaults)
+                edge.update(attrs)
+                for src, dst in itertools.izip(nodes, nodes[1:]):
+                    yield ('edge', src, dst, dict(edge))
+
+def gml_list(ts):
+    '''parses the rest of a [ ... ] list into a dict; repeated keys keep
+    their last value'''
+    items = {}
+    while True:
+        kind, key = ts.next()
+        if key == ']':
+            return items
+        if kind != 'id':
+            raise ParseError("expected a key, got %r" % (key))
+        items[key] = gml_value(ts)
+
+def gml_value(ts):
+    kind, t = ts.next()
+    if t == '[':
+        return gml_list(ts)
+    if kind == 'str':
+        return t[1:-1]
+    if kind == 'num':
+        if re.match(r'^[-+]?[0-9]+$', t):
+            return int(t)
+        return float(t)
+    raise ParseError("expected a value, got %r" % (t))
+
+RATES = [(10 ** 12, 'Tbps'), (10 ** 9, 'Gbps'), (10 ** 6, 'Mbps'), (10 ** 3, 'kbps')]
+
+def gml_capacity(edge, default='1Gbps'):
+    '''capacity of a Topology Zoo link, from its speed in bits per second'''
+    raw = edge.get('LinkSpeedRaw')
+    if not raw:
+        return default
+    for mult, unit in RATES:
+        if raw >= mult and raw % mult == 0:
+            return "%d%s" % (raw / mult, unit)
+    return "%dkbps" % (max(1, round(raw / 1000.0)))
+
+def gml_events(f):
+    '''yields the events of a GML file; nodes are named by their id, and
+    the graph event is yielded again for its label and directed keys'''
+    ts = TokenStream(tokens(f, GML_TOKEN))
+    while True:
+        kind, key = ts.next()
+        if kind is None:
+            raise ParseError("no graph in GML file")
+        if key == 'graph':
+            break
+        gml_value(ts)
+    ts.expect('[')
+    name = None
+    graph = 'graph'
+    while True:
+        kind, key = ts.next()
+        if key == ']':
+            break
+        if kind != 'id':
+            raise ParseError("expected a key, got %r" % (key))
+        value = gml_value(ts)
+        if key in ('label', 'directed'):
+            if key == 'label':
+                name = value
+            elif value:
+                graph = 'digraph'
+            yield ('graph', name, graph)
+        elif key == 'node':
+            attrs = {'type': 'switch', 'id': value['id']}
+            for k in ('label', 'ip', 'mac'):
+                if k in value:
+                    attrs[k] = value[k]
+            yield ('node', str(value['id']), attrs)
+        elif key == 'edge':
+            yield ('edge', str(value['source']), str(value['target']),
+                   {'sport': value['target'], 'dport': value['source'],
+                    'capacity': gml_capacity(value), 'cost': 1})
+
+def events(path):
+    '''yields the events of the DOT or GML file path'''
+    with open(path) as f:
+        if path.endswith('.gml'):
+            for event in gml_events(f):
+                yield event
+        else:
+            for event in dot_events(f):
+                yield event
+
+class Topology(object):
+    '''a topology file read in two passes. nodes maps every node, including
+    the ones only named by edges, to its attributes, in the order they first
+    appear; kind is the kind of graph of its events; edges() reads the file
+    again and yields (src, dst, attrs).'''
+
+    def __init__(self, path):
+        self.path = path
+        self.name = None
+        self.kind = 'graph'
+        self.nodes = OrderedDict()
+        for event in events(path):
+            if event[0] == 'graph':
+                self.name = event[1]
+                self.kind = event[2]
+            elif event[0] == 'node':
+                self.nodes.setdefault(event[1], {}).update(event[2])
+            else:
+                self.nodes.setdefault(event[1], {})
+                self.nodes.setdefault(event[2], {})
+        # GML nodes are renamed by their label, made unique with their id
+        self.names = {}
+        if path.endswith('.gml'):
+            nodes = OrderedDict()
+            for node, attrs in self.nodes.iteritems():
+                name = attrs.pop('label', node)
+                if name in nodes:
+                    name = "%s_%s" % (name, node)
+                self.names[node] = name
+                nodes[name] = attrs
+            self.nodes = nodes
+
+    def edges(self):
+        names = self.names
+        for event in events(self.path):
+            if event[0] == 'edge':
+                yield names.get(event[1], event[1]), names.get(event[2], event[2]), event[3]
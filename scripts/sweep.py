@@ -0,0 +1,119 @@
+#!/usr/bin/python
+
+'''This file writes the policies of abfattree.py for many configurations in
+one run. Every tree is generated and routed once, and all the requested
+policy types of it are written from that state, one file per combination,
+by a pool of -j workers that share it:
+
+  sweep.py -F 4 8 -D 3 -t tables paths --ft nofail fail -d out -j 4
+'''
+
+import sys
+import os
+import time
+import argparse
+import itertools
+import abfattree
+
+def combinations(kattypes, failovers, localities):
+    '''the (kattype, failover, local) to write; regular has no failover'''
+    for kattype, failover, local in itertools.product(kattypes, failovers, localities):
+        if kattype == 'regular' and failover == 'fail':
+            continue
+        yield kattype, failover, local
+
+def policy_path(outdir, fanout, depth, kattype, failover, local):
+    return os.path.join(outdir, "abfattree-%d-%d-%s-%s-%s.kat" % (fanout, depth, kattype, failover, local))
+
+# the tree of the current sweep, shared by the forked workers
+_sweep_graph = None
+
+def sweep_task(args):
+    '''writes one policy of _sweep_graph and returns its result; a failed
+    combination is a result too, and the others go on'''
+    kattype, failover, local, path = args
+    start = time.time()
+    try:
+        abfattree.to_netkat(_sweep_graph, kattype, path, failover == 'fail', local == 'local')
+        return {'output': path, 'status': 'ok', 'bytes': os.path.getsize(path), 'time': time.time() - start}
+    except Exception as e:
+        return {'output': path, 'status': 'failed',
+                'error': "%s: %s" % (type(e).__name__, e), 'time': time.time() - start}
+
+def sweep(graph, tasks, jobs=1):
+    '''writes the policies of tasks (kattype, failover, local, path) of graph
+    with jobs worker processes and returns the result of every policy'''
+    global _sweep_graph
+    if getattr(graph, 'down', None) is None:
+        abfattree.compute_routes(graph)
+    # shared with the workers as in abfattree.sharded()
+    _sweep_graph = graph
+    if jobs > 1 and len(tasks) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(jobs, len(tasks)))
+        try:
+            results = list(pool.imap(sweep_task, tasks))
+            pool.close()
+            pool.join()
+        except:
+            pool.terminate()
+            raise
+    else:
+        results = map(sweep_task, tasks)
+    return results
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-F", "--fanouts", dest='fanouts', nargs='+', type=int,
+                        required=True,
+                        help='fanouts of the trees')
+    parser.add_argument("-D", "--depths", dest='depths', nargs='+', type=int,
+                        required=True,
+                        help='depths of the trees')
+    parser.add_argument("-t", "--types", dest='kattypes', nargs='+',
+                        choices=abfattree.KATTYPES, default=['tables'],
+                        help='KAT policy types to write')
+    parser.add_argument("--ft", dest='failovers', nargs='+',
+                        choices=['nofail', 'fail'], default=['nofail'],
+                        help='failover settings to write')
+    parser.add_argument("--local", dest='localities', nargs='+',
+                        choices=['full', 'local'], default=['full'],
+                        help='local settings to write')
+    parser.add_argument("--prefixes", dest='prefixes', action='store_true',
+                        help='match the hosts below a switch in up-port rules by ip4Dst prefixes instead of one ethDst each')
+    parser.add_argument("--dot", dest='dot', action='store_true',
+                        help='also write the DOT topology of every tree')
+    parser.add_argument("-d", "--outdir", dest='outdir', action='store',
+                        default='.',
+                        help='directory to write the policies to')
+    parser.add_argument("-j", "--jobs", dest='jobs', action='store', type=int,
+                        default=1,
+                        help='number of policies written at once')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+
+    failed = 0
+    for fanout, depth in itertools.product(args.fanouts, args.depths):
+        start = time.time()
+        graph = abfattree.generate(fanout, depth)
+        graph.prefixes = args.prefixes
+        if args.dot:
+            with open(os.path.join(args.outdir, "abfattree-%d-%d.dot" % (fanout, depth)), 'w') as f:
+                graph.write_dot(f)
+        abfattree.compute_routes(graph)
+        print >> sys.stderr, "abfattree %d %d: generated and routed in %.3fs" % (fanout, depth, time.time() - start)
+        tasks = [(kattype, failover, local, policy_path(args.outdir, fanout, depth, kattype, failover, local))
+                 for kattype, failover, local in combinations(args.kattypes, args.failovers, args.localities)]
+        for r in sweep(graph, tasks, args.jobs):
+            if r['status'] == 'ok':
+                print >> sys.stderr, "  %-56s %8.3fs %12d bytes" % (os.path.basename(r['output']), r['time'], r['bytes'])
+            else:
+                failed += 1
+                print >> sys.stderr, "  %-56s failed: %s" % (os.path.basename(r['output']), r['error'])
+    if failed:
+        exit(1)
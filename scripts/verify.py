@@ -0,0 +1,159 @@
+#!/usr/bin/python
+
+'''This file checks that the switch tables of an AB fat tree deliver a
+packet between every pair of hosts, exactly once and to the right host:
+
+  verify.py 32 3
+  verify.py 8 3 -f fail --fail-link s1 s33
+  abfattree.py 8 3 -n -f fail -b tables.bin; verify.py 8 3 -b tables.bin
+
+The tables are the rules of -t tables of abfattree.py, built from its
+routing state, or read back from a file of abfattree.py -b. All the pairs
+of a batch of source hosts are forwarded at once by forwarding.py. A pair
+fails if its packet loops, reaches another host, is dropped (a black hole)
+or is delivered more than once. With --fail-sweep, the failover tables are
+checked against every single switch link failure; a failover rule
+sends on its backup port when the link of its port is down, as in
+forwarding.forward.'''
+
+import sys
+import time
+import argparse
+import numpy as np
+import abfattree
+import flowtable
+import forwarding
+
+KINDS = ['looping', 'wrong', 'dropped', 'duplicated']
+
+def table_rules(tables):
+    '''the rules of a flowtable.FlowTables'''
+    for r in tables.records:
+        switch, inport, outport, backup, flags, pad, lo, hi = map(int, r)
+        outports = (outport, backup) if backup else (outport,)
+        yield switch, inport, bool(flags & flowtable.NEGATE), lo, hi, outports
+
+def all_pairs(H, batch):
+    '''yields batches (src, dst) of all the pairs of different host indices'''
+    step = max(1, batch / max(1, H - 1))
+    for first in range(0, H, step):
+        src = np.repeat(np.arange(first, min(H, first + step)), H)
+        dst = np.tile(np.arange(H), len(src) / H)
+        keep = src != dst
+        yield src[keep], dst[keep]
+
+def verify(graph, classifier, dead, batch=1 << 20, show=0):
+    '''forwards a packet for every pair of hosts and returns (pairs, counts,
+    samples): the number of pairs that fail in every way of KINDS, and up
+    to show (src, dst, kind, node) of the failed pairs. A pair is counted
+    once, as the first kind of KINDS it fails in.'''
+    counts = dict.fromkeys(KINDS, 0)
+    samples = []
+    pairs = 0
+    for src, dst in all_pairs(graph.nhosts, batch):
+        n = len(src)
+        pairs += n
+        delivered = np.zeros(n, np.int64)
+        kind = np.full(n, len(KINDS), np.int64)
+        where = np.full(n, -1, np.int64)
+        for event in forwarding.forward(graph, classifier, dead, src, dst):
+            if event[0] == 'link':
+                continue
+            if event[0] == 'delivered':
+                delivered += np.bincount(event[1], event[2], n).astype(np.int64)
+                continue
+            flows = event[1]
+            k = KINDS.index(event[0])
+            worse = k < kind[flows]
+            kind[flows[worse]] = k
+            if len(event) > 3:
+                where[flows[worse]] = event[3][worse]
+        # a packet that is dropped or misdelivered by one copy but delivered
+        # by another is still a failure; an undelivered one is a black hole
+        black = (kind == len(KINDS)) & (delivered == 0)
+        kind[black] = KINDS.index('dropped')
+        kind[(kind == len(KINDS)) & (delivered > 1)] = KINDS.index('duplicated')
+        for k, name in enumerate(KINDS):
+            bad = np.flatnonzero(kind == k)
+            counts[name] += len(bad)
+            for i in bad[:max(0, show - len(samples))]:
+                samples.append((src[i], dst[i], name, where[i]))
+    return pairs, counts, samples
+
+def describe(graph, sample):
+    src, dst, kind, node = sample
+    s = "%s -> %s: %s" % (graph.name(src + graph.nswitches), graph.name(dst + graph.nswitches), kind)
+    if kind == 'dropped' and node >= 0:
+        s += " at %s" % (graph.name(node))
+    elif kind == 'wrong' and node >= 0:
+        s += " to %s" % (graph.name(node))
+    return s
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("fanout", type=int,
+                        help="number of children each node should have")
+    parser.add_argument("depth", type=int,
+                        help="depth of the fattree")
+    parser.add_argument("-f", "--ft", dest='failover', action='store',
+                        choices=['nofail', 'fail'], default='nofail',
+                        help='check the failover tables')
+    parser.add_argument("-b", "--binary", dest='binary', action='store',
+                        default=None,
+                        help='check the tables of this file of abfattree.py -b instead')
+    parser.add_argument("--fail-link", dest='faillinks', action='append',
+                        nargs=2, metavar=('A', 'B'), default=[],
+                        help='take the link between nodes A and B (e.g. s1 s9) down')
+    parser.add_argument("--fail-sweep", dest='failsweep', action='store_true',
+                        help='check every single switch link failure')
+    parser.add_argument("--batch", dest='batch', action='store', type=int,
+                        default=1 << 20,
+                        help='pairs forwarded at once')
+    parser.add_argument("--show", dest='show', action='store', type=int,
+                        default=10,
+                        help='number of failed pairs to list')
+    return parser, parser.parse_args()
+
+
+if __name__ == "__main__":
+    parser, args = parse_args()
+    start = time.time()
+    graph = abfattree.generate(args.fanout, args.depth)
+    abfattree.compute_routes(graph)
+    if args.binary:
+        tables = flowtable.FlowTables(args.binary)
+        if tables.nswitches != graph.nswitches:
+            print >> sys.stderr, "%s has %d switches, not %d" % (args.binary, tables.nswitches, graph.nswitches)
+            exit(1)
+        rules = table_rules(tables)
+    else:
+        rules = abfattree.flow_rules(graph, graph.switches, args.failover == 'fail')
+    classifier = forwarding.Classifier(graph, rules)
+    print >> sys.stderr, "%d hosts, tables built in %.3fs" % (graph.nhosts, time.time() - start)
+
+    try:
+        links = [(graph.node(a), graph.node(b)) for a, b in args.faillinks]
+        forwarding.failed_ports(graph, links)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.failsweep:
+        failures = [links + [link] for link in abfattree.switch_links(graph)]
+    else:
+        failures = [links]
+    failed = 0
+    for down in failures:
+        start = time.time()
+        pairs, counts, samples = verify(graph, classifier, forwarding.failed_ports(graph, down), args.batch,
+                                        args.show)
+        bad = sum(counts.values())
+        if args.failsweep or down:
+            print "failed links: %s" % (", ".join(["%s-%s" % (graph.name(a), graph.name(b)) for a, b in down]))
+        print "%d pairs in %.3fs: %d ok, %d looping, %d wrong host, %d black holes, %d duplicated" % \
+            (pairs, time.time() - start, pairs - bad, counts['looping'], counts['wrong'], counts['dropped'],
+             counts['duplicated'])
+        for sample in samples:
+            print "  " + describe(graph, sample)
+        if bad:
+            failed += 1
+    if failed:
+        exit(1)